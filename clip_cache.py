@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from ogg_opus import write_ogg_opus
+from response_cache import normalize_prompt
+
+
+def clip_key(voice_uuid, text, sample_rate):
+    encoded = json.dumps([voice_uuid, normalize_prompt(text), sample_rate])
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ClipCache:
+    # synthesized speech stored as Ogg/Opus files, one per voice, normalized
+    # text and sample rate, so a repeated line is played without synthesizing
+    # or encoding it again. Files are evicted least recently used first once
+    # they take more than max_bytes; file modification times record use
+    # across restarts
+    def __init__(self, root, max_bytes=256 << 20):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> file size
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.ogg")
+
+    def load(self):
+        files = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".ogg"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[:-len(".ogg")], stat.st_size))
+            elif name.endswith(".tmp"):
+                # left half written by a crash
+                os.remove(path)
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total += size
+
+    def get(self, key):
+        # the clip's Ogg/Opus data, or None
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.total -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, packets):
+        path = self.path(key)
+        write_ogg_opus(path, packets)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"clips": len(self.entries), "bytes": self.total, "hits": self.hits, "misses": self.misses}
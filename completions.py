@@ -0,0 +1,155 @@
+import asyncio
+
+import aiohttp
+import openai
+
+from response_cache import request_key
+
+DEFAULT_ENGINE = "text-davinci-003"
+
+
+class CompletionClient:
+    # async wrapper around the completions endpoint that keeps one long-lived
+    # aiohttp session so requests never block the discord event loop
+    def __init__(self, engine=DEFAULT_ENGINE, max_tokens=150, temperature=0.5,
+                 request_timeout=60, max_connections=20, cache=None):
+        self.engine = engine
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.cache = cache
+        self.session = None
+
+    def _get_session(self):
+        # created lazily so the session is bound to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    def _params(self, prompt, **overrides):
+        params = {
+            "engine": self.engine,
+            "prompt": prompt,
+            "max_tokens": self.max_tokens,
+            "n": 1,
+            "stop": None,
+            "temperature": self.temperature,
+            "request_timeout": self.request_timeout,
+        }
+        params.update(overrides)
+        return params
+
+    async def create(self, prompt, **overrides):
+        # openai reads the session from a context variable, which is copied per
+        # task, so it is set on every call instead of once at startup
+        openai.aiosession.set(self._get_session())
+        return await openai.Completion.acreate(**self._params(prompt, **overrides))
+
+    def request_key(self, prompt, **overrides):
+        return request_key(self._params(prompt, **overrides))
+
+    def cached(self, prompt, **overrides):
+        if self.cache is None:
+            return None
+        return self.cache.get(self._params(prompt, **overrides))
+
+    def _store(self, prompt, text, **overrides):
+        if self.cache is not None:
+            self.cache.put(self._params(prompt, **overrides), text)
+
+    async def complete(self, prompt, **overrides):
+        response = await self.create(prompt, **overrides)
+        text = response.choices[0].text.strip()
+        self._store(prompt, text, **overrides)
+        return text
+
+    async def stream(self, prompt, **overrides):
+        # yields text fragments as the completion is generated
+        openai.aiosession.set(self._get_session())
+        response = await openai.Completion.acreate(stream=True, **self._params(prompt, **overrides))
+        parts = []
+        async for part in response:
+            text = part.choices[0].text
+            if text:
+                parts.append(text)
+                yield text
+        self._store(prompt, "".join(parts).strip(), **overrides)
+
+    async def close(self):
+        if self.cache is not None:
+            self.cache.save()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+class CompletionBatcher:
+    # groups prompts that arrive within a short window into one request, the
+    # completions endpoint accepts a list of prompts and tags each choice with
+    # the index of the prompt it answers. Prompts are only batched with others
+    # from the same guild, so with a scheduler each request (not each prompt)
+    # takes one of its slots in that guild's queue, as the first prompt's user
+    def __init__(self, client, window_ms=25, max_batch=8, scheduler=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = {}  # (guild id, request options) -> [(prompt, future, guild id, user id), ...]
+        self.timers = {}
+        self.tasks = set()
+        self.batches = 0
+        self.batched_prompts = 0
+
+    async def complete(self, prompt, guild_id=None, user_id=None, **overrides):
+        loop = asyncio.get_running_loop()
+        key = (guild_id, tuple(sorted(overrides.items())))
+        batch = self.pending.setdefault(key, [])
+        future = loop.create_future()
+        batch.append((prompt, future, guild_id, user_id))
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [entry for entry in self.pending.pop(key, []) if not entry[1].done()]
+        if batch:
+            task = asyncio.ensure_future(self._send(batch, dict(key[1])))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch, overrides):
+        self.batches += 1
+        self.batched_prompts += len(batch)
+        prompts = [prompt for prompt, *_ in batch]
+        try:
+            if self.scheduler is None:
+                response = await self.client.create(prompts, **overrides)
+            else:
+                _, _, guild_id, user_id = batch[0]
+                response = await self.scheduler.run(self.client.create, prompts, guild_id=guild_id,
+                                                    user_id=user_id, **overrides)
+        except Exception as e:
+            for _, future, *_ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # with n > 1 every prompt gets n consecutive choices, keep the first
+        n = overrides.get("n", 1)
+        texts = [None] * len(batch)
+        for choice in response.choices:
+            i = choice.index // n
+            if texts[i] is None:
+                texts[i] = choice.text.strip()
+
+        for (prompt, future, *_), text in zip(batch, texts):
+            self.client._store(prompt, text, **overrides)
+            if not future.done():
+                future.set_result(text)
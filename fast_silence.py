@@ -0,0 +1,209 @@
+import numpy as np
+
+# drop-in replacements for pydub.silence.detect_silence, detect_nonsilent and
+# split_on_silence: the rms of every min_silence_len window is taken from a
+# cumulative sum of squared samples, so the cost is O(n) instead of one slice
+# and audioop.rms call per seek_step
+
+
+def samples_of(audio_segment):
+    # signed samples, read the way audioop reads them
+    data = audio_segment.raw_data
+    width = audio_segment.sample_width
+    if width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int64)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        return np.where(samples >= 1 << 23, samples - (1 << 24), samples)
+    if width == 4:
+        # squares of 32 bit samples overflow int64 once summed, audioop sums
+        # them as doubles too
+        return np.frombuffer(data, dtype="<i4").astype(np.float64)
+    return np.frombuffer(data, dtype={1: np.int8, 2: "<i2"}[width]).astype(np.int64)
+
+
+def _threshold(silence_thresh, sample_width):
+    # same conversion as pydub: dBFS to an amplitude of the sample width
+    return 10 ** (silence_thresh / 20) * (2 ** (sample_width * 8) / 2)
+
+
+def _window_rms(frame_sums, channels, frame_rate, frame_count, starts_ms, ends_ms):
+    # integer rms (like audioop.rms) of the frames between each pair of ms
+    # positions, counting frames past the end as zero padding the way pydub
+    # pads its slices
+    csum = np.concatenate(([0], np.cumsum(frame_sums)))
+    start = (starts_ms * (frame_rate / 1000.0)).astype(np.int64)
+    end = (ends_ms * (frame_rate / 1000.0)).astype(np.int64)
+    sums = csum[np.minimum(end, frame_count)] - csum[np.minimum(start, frame_count)]
+    n = (end - start) * channels
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n > 0, np.floor(np.sqrt(sums / np.maximum(n, 1))), 0)
+
+
+def _combine(silence_starts, min_silence_len, seek_step):
+    # joins silent window starts into [start, end] ranges like pydub does:
+    # a range only breaks where the starts are neither consecutive steps nor
+    # overlapping windows
+    if not len(silence_starts):
+        return []
+    gaps = np.diff(silence_starts)
+    breaks = np.flatnonzero((gaps != seek_step) & (gaps > min_silence_len))
+    range_starts = np.concatenate(([silence_starts[0]], silence_starts[breaks + 1]))
+    range_ends = np.concatenate((silence_starts[breaks], [silence_starts[-1]])) + min_silence_len
+    return [[int(s), int(e)] for s, e in zip(range_starts, range_ends)]
+
+
+def detect_silence(audio_segment, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    seg_len = len(audio_segment)
+    if seg_len < min_silence_len:
+        return []
+
+    channels = audio_segment.channels
+    samples = samples_of(audio_segment)
+    frame_count = len(samples) // channels
+    frame_sums = (samples[:frame_count * channels] ** 2).reshape(frame_count, channels).sum(axis=1)
+
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step, dtype=np.int64)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+    ends = np.minimum(starts + min_silence_len, seg_len)
+
+    rms = _window_rms(frame_sums, channels, audio_segment.frame_rate, frame_count, starts, ends)
+    silent = rms <= _threshold(silence_thresh, audio_segment.sample_width)
+    return _combine(starts[silent], min_silence_len, seek_step)
+
+
+def detect_nonsilent(audio_segment, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    silent_ranges = detect_silence(audio_segment, min_silence_len, silence_thresh, seek_step)
+    len_seg = len(audio_segment)
+
+    if not silent_ranges:
+        return [[0, len_seg]]
+    if silent_ranges[0][0] == 0 and silent_ranges[0][1] == len_seg:
+        return []
+
+    prev_end_i = 0
+    nonsilent_ranges = []
+    for start_i, end_i in silent_ranges:
+        nonsilent_ranges.append([prev_end_i, start_i])
+        prev_end_i = end_i
+    if end_i != len_seg:
+        nonsilent_ranges.append([prev_end_i, len_seg])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+
+def split_on_silence(audio_segment, min_silence_len=1000, silence_thresh=-16, keep_silence=100, seek_step=1):
+    if isinstance(keep_silence, bool):
+        keep_silence = len(audio_segment) if keep_silence else 0
+
+    output_ranges = [
+        [start - keep_silence, end + keep_silence]
+        for start, end in detect_nonsilent(audio_segment, min_silence_len, silence_thresh, seek_step)
+    ]
+    # share the silence between neighbours whose kept silence overlaps
+    for range_i, range_ii in zip(output_ranges, output_ranges[1:]):
+        if range_ii[0] < range_i[1]:
+            range_i[1] = (range_i[1] + range_ii[0]) // 2
+            range_ii[0] = range_i[1]
+
+    return [
+        audio_segment[max(start, 0):min(end, len(audio_segment))]
+        for start, end in output_ranges
+    ]
+
+
+class StreamingSilenceDetector:
+    # detect_silence over live pcm: feed() takes audio as it is recorded and
+    # returns the silent ranges (in ms from the start of the stream) that can
+    # no longer grow; finish() returns the last one. Results match
+    # detect_silence for audio that is a whole number of milliseconds long
+    def __init__(self, frame_rate, channels, sample_width=2, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+        if frame_rate % 1000:
+            raise ValueError("streaming detection needs a frame rate in whole kHz")
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.min_silence_len = min_silence_len
+        self.seek_step = seek_step
+        self.threshold = _threshold(silence_thresh, sample_width)
+        self.pending = bytearray()
+        self.ms_sums = np.zeros(0, dtype=np.float64 if sample_width == 4 else np.int64)  # last min_silence_len - 1 ms
+        self.position = 0  # ms of audio consumed
+        self.last_window = None  # sum of squares of the newest full window
+        self.range_start = None
+        self.prev = None
+
+    @property
+    def in_silence(self):
+        # whether the newest audio is part of a silent range that can still grow
+        return self.range_start is not None
+
+    def feed(self, data):
+        self.pending += data
+        ms_bytes = self.frame_rate // 1000 * self.channels * self.sample_width
+        count = len(self.pending) // ms_bytes
+        if not count:
+            return []
+
+        block = bytes(self.pending[:count * ms_bytes])
+        del self.pending[:count * ms_bytes]
+        dtype = {1: np.int8, 2: "<i2", 4: "<i4"}[self.sample_width]
+        samples = np.frombuffer(block, dtype=dtype).astype(np.float64 if self.sample_width == 4 else np.int64)
+        new_sums = (samples ** 2).reshape(count, -1).sum(axis=1)
+
+        first_ms = self.position - len(self.ms_sums)
+        sums = np.concatenate((self.ms_sums, new_sums))
+        self.position += count
+        self.ms_sums = sums[-(self.min_silence_len - 1):] if self.min_silence_len > 1 else sums[:0]
+
+        windows = len(sums) - self.min_silence_len + 1
+        if windows <= 0:
+            return []
+        csum = np.concatenate(([0], np.cumsum(sums)))
+        starts = first_ms + np.arange(windows, dtype=np.int64)
+        window_sums = csum[self.min_silence_len:] - csum[:windows]
+        self.last_window = window_sums[-1]
+        rms = np.floor(np.sqrt(window_sums / self._window_samples()))
+
+        on_step = starts % self.seek_step == 0
+        silent_starts = starts[on_step & (rms <= self.threshold)]
+        closed = self._extend(silent_starts)
+        # no later window can join the open range once the next one starts
+        # past its end
+        if self.range_start is not None and starts[-1] + 1 > self.prev + max(self.min_silence_len, self.seek_step):
+            closed.append([self.range_start, self.prev + self.min_silence_len])
+            self.range_start = self.prev = None
+        return closed
+
+    def _extend(self, silent_starts):
+        closed = []
+        if not len(silent_starts):
+            return closed
+        if self.prev is not None:
+            silent_starts = np.concatenate(([self.prev], silent_starts))
+        ranges = _combine(silent_starts, self.min_silence_len, self.seek_step)
+        if self.range_start is not None:
+            ranges[0][0] = self.range_start
+        # the last range can still grow with the next window
+        closed, last = ranges[:-1], ranges[-1]
+        self.range_start = last[0]
+        self.prev = int(silent_starts[-1])
+        return closed
+
+    def _window_samples(self):
+        return self.min_silence_len * self.frame_rate // 1000 * self.channels
+
+    def finish(self):
+        # like detect_silence, the final window is checked even when it does
+        # not start on a seek step
+        closed = []
+        last_slice_start = self.position - self.min_silence_len
+        if self.last_window is not None and last_slice_start % self.seek_step:
+            if np.floor(np.sqrt(self.last_window / self._window_samples())) <= self.threshold:
+                closed = self._extend(np.array([last_slice_start], dtype=np.int64))
+        if self.range_start is not None:
+            closed.append([self.range_start, self.prev + self.min_silence_len])
+        self.range_start = self.prev = self.last_window = None
+        return closed
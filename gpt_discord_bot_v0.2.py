@@ -1,18 +1,27 @@
+import asyncio
+import io
 import os
 import openai
-import whisper
 from resemble import Resemble
 import discord
 import random
 from discord.ext import commands
 from dotenv import load_dotenv
-from pydub import AudioSegment
 from datetime import timedelta
-
-load_dotenv()
-DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-RESEMBLE_API_KEY = os.getenv("RESEMBLE_API_KEY")
+from completions import CompletionBatcher, CompletionClient
+from response_cache import ResponseCache
+from scheduler import FairScheduler, QueueFull
+from single_flight import SingleFlight
+from streaming import EditPacer, stream_reply
+from transcription import TranscriptionWorker, file_hash, transcribe_chunks
+from resemble_client import AsyncResemble
+from uploads import RecordingUploader, UploadManifest
+from recording_store import RecordingStore
+from vad import SpeechDetector
+from clip_cache import ClipCache, clip_key
+from tts_stream import stream_clip
+from voice_playback import OggOpusSource, OpusEncoderPool, OpusStreamingSource
+from voice_recording import RecordingVoiceClient, SpoolSink
 
 intents = discord.Intents.default()
 intents.typing = False
@@ -21,35 +30,63 @@ intents.message_content = True
 intents.guilds = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-# Set up OpenAI API
-openai.api_key = OPENAI_API_KEY
-# Set up Resemble API
-Resemble.api_key(RESEMBLE_API_KEY)
-# Set up Whisper model
-model = whisper.load_model("base")
+class GPTBot(commands.Bot):
+    # on_ready runs again after every reconnect
+    warmed_up = False
+
+    async def close(self):
+        await completions.close()
+        transcriber.shutdown()
+        await resemble.close()
+        opus_encoders.shutdown()
+        await super().close()
+
+
+# Stream !gpt replies by editing the message as tokens arrive
+STREAM_RESPONSES = True
+# Running !train tasks by user id, so they can be cancelled
+training_tasks = {}
+# Speech is synthesized at the voice player's rate and streamed in 20 ms
+# buffers, so playback starts with the first buffer
+TTS_SAMPLE_RATE = 48000
+TTS_BUFFER_SIZE = TTS_SAMPLE_RATE // 50 * 2
+
+
+async def fetch_gpt4_response(prompt, guild_id=None, user_id=None):
+    cached = completions.cached(prompt)
+    if cached is not None:
+        return cached
+    return await single_flight.run(
+        completions.request_key(prompt),
+        batcher.complete, prompt, guild_id=guild_id, user_id=user_id,
+    )
 
 
-async def fetch_gpt4_response(prompt):
-    response = openai.Completion.create(
-        engine="text-davinci-003",  # Replace this with the desired GPT engine
-        prompt=prompt,
-        max_tokens=150,
-        n=1,
-        stop=None,
-        temperature=0.5,
+async def stream_gpt4_response(channel, prompt, guild_id=None, user_id=None):
+    cached = completions.cached(prompt)
+    if cached is not None:
+        await channel.send(cached)
+        return cached
+    key = completions.request_key(prompt)
+    if key in single_flight:
+        # an identical request is already streaming elsewhere, reuse its text
+        response = await single_flight.wait(key)
+        await channel.send(response)
+        return response
+    return await single_flight.run(
+        key, scheduler.run, stream_reply, channel.send, completions.stream(prompt), edit_pacer, channel.id,
+        guild_id=guild_id, user_id=user_id,
     )
 
-    return response.choices[0].text.strip()
-
 
-@bot.event
 async def on_ready():
     print(f"{bot.user} has connected to Discord!")
+    if not bot.warmed_up:
+        # later jobs restart the pool themselves after an idle shutdown
+        bot.warmed_up = True
+        transcriber.warm_up()
 
 
-@bot.event
 async def on_message(message):
     await bot.process_commands(message)
     if message.author == bot.user:
@@ -80,60 +117,145 @@ async def on_message(message):
         [PERSPECTIVE]: [RESPONSE]\n
         Do not vary from this format at all."""
         prompt = "STATEMENT: " + message.content + "\n" + directive
-        response = await fetch_gpt4_response(prompt)
+        guild_id = message.guild.id if message.guild else None
+        try:
+            response = await fetch_gpt4_response(prompt, guild_id, message.author.id)
+        except QueueFull as e:
+            print(f"Skipped response: {e}")
+            return
         await message.reply(response)
         print("|-----------------------------------------------------------------------------")
         print(f"|Sent response: {response}")
         print("|-----------------------------------------------------------------------------")
 
-@bot.command()
+@commands.command()
 async def gpt(ctx, *, prompt):
     directive = "\n-----------------"
     prompt = prompt + directive
     print("|-----------------------------------------------------------------------------")
     print(f"|Received GPT-4 command: !gpt4 {prompt}")
     print("|------")
-    response = await fetch_gpt4_response(prompt)
-    await ctx.send(response)
+    guild_id = ctx.guild.id if ctx.guild else None
+    try:
+        if STREAM_RESPONSES:
+            response = await stream_gpt4_response(ctx.channel, prompt, guild_id, ctx.author.id)
+        else:
+            response = await fetch_gpt4_response(prompt, guild_id, ctx.author.id)
+            await ctx.send(response)
+    except QueueFull as e:
+        await ctx.send(f"{e}, try again in a moment")
+        return
     print(f"|Sent response: {response}")
     print("|-----------------------------------------------------------------------------")
 
+# completion queue metrics
+@commands.command()
+async def gptstats(ctx):
+    stats = scheduler.stats()
+    clips = clip_cache.stats()
+    guild_id = ctx.guild.id if ctx.guild else None
+    await ctx.send(
+        f"in flight: {stats['in_flight']}, queued: {stats['queued']} "
+        f"({scheduler.queue_length(guild_id)} from this server), rejected: {stats['rejected']}\n"
+        f"wait: {stats['mean_wait']:.2f}s avg / {stats['max_wait']:.2f}s max, "
+        f"service: {stats['mean_service']:.2f}s avg / {stats['max_service']:.2f}s max "
+        f"over {stats['served']} requests\n"
+        f"cache: {response_cache.hits} hits / {response_cache.misses} misses, "
+        f"{len(response_cache.entries)} entries, {single_flight.shared} coalesced requests\n"
+        f"batching: {batcher.batched_prompts} prompts in {batcher.batches} requests\n"
+        f"speech cache: {clips['hits']} hits / {clips['misses']} misses, "
+        f"{clips['clips']} clips, {clips['bytes'] / (1 << 20):.1f} MB"
+    )
+
 # join vc
-@bot.command()
+@commands.command()
 async def join(ctx):
     if ctx.author.voice:
         channel = ctx.message.author.voice.channel
-        await channel.connect()
+        await channel.connect(cls=RecordingVoiceClient)
     else:
         await ctx.send("not in a voice channel!")
 
 # leave vc
-@bot.command()
+@commands.command()
 async def leave(ctx):
     if ctx.voice_client:
         await ctx.voice_client.disconnect()
     else:
         await ctx.send("not in a voice channel!")
 
-@bot.command()
+# speak in the voice channel
+@commands.command()
+async def say(ctx, *, text):
+    if not ctx.voice_client:
+        await ctx.send("not in a voice channel!")
+        return
+    if not RESEMBLE_PROJECT_UUID or not RESEMBLE_VOICE_UUID or not RESEMBLE_SYN_SERVER_URL:
+        await ctx.send("speech is not set up")
+        return
+    await speak(ctx.voice_client, text)
+
+async def speak(voice_client, text, voice_uuid=None):
+    # plays a cached line straight away, otherwise streams the synthesized
+    # speech into the voice channel as it arrives and caches its packets
+    voice_uuid = voice_uuid or RESEMBLE_VOICE_UUID
+    key = clip_key(voice_uuid, text, TTS_SAMPLE_RATE)
+    data = await asyncio.to_thread(clip_cache.get, key)
+    if data is not None:
+        play(voice_client, OggOpusSource(io.BytesIO(data)))
+        print(f"Playing cached speech for {text!r}")
+        return
+
+    buffers = stream_clip(
+        RESEMBLE_PROJECT_UUID, voice_uuid, text,
+        buffer_size=TTS_BUFFER_SIZE, sample_rate=TTS_SAMPLE_RATE,
+    )
+    source = OpusStreamingSource(buffers, TTS_SAMPLE_RATE, opus_encoders, keep=True)
+    if not await asyncio.to_thread(source.wait_ready, 30):
+        source.cleanup()
+        print(f"No speech synthesized for {text!r}: {source.error}")
+        return
+    play(voice_client, source, after=lambda e: print(
+        f"Finished speaking ({source.underruns} underruns){f': {e}' if e else ''}"))
+    print(f"Started speaking {source.first_audio:.2f}s after synthesis began")
+
+    await asyncio.to_thread(source.thread.join)
+    if source.complete:
+        await asyncio.to_thread(clip_cache.put, key, source.recording)
+
+def play(voice_client, source, after=None):
+    # a new line interrupts the one being spoken
+    if voice_client.is_playing():
+        voice_client.stop()
+    voice_client.play(source, after=after)
+
+@commands.command()
 async def listen(ctx):
     if ctx.voice_client:
-        ctx.voice_client.start_recording(discord.sinks.WaveSink(), callback, ctx)
+        key = str(ctx.author)
+
+        # runs on the recording thread whenever a spool file is finished
+        def store_segment(user_id, segment):
+            with open(segment.path, "rb") as f:
+                recording_store.append(
+                    key, f, SpoolSink.sample_rate, SpoolSink.channels, SpoolSink.sample_width,
+                    started=segment.started, ended=segment.ended,
+                )
+            os.remove(segment.path)
+
+        sink = SpoolSink(os.path.join("recordings", "spool"), store_segment, filters={"users": [ctx.author.id]})
+        ctx.voice_client.start_recording(sink, callback, ctx)
         await ctx.send("listening...")
     else:
         await ctx.send("not in a voice channel!")
 
 async def callback(sink: discord.sinks, ctx):
-    for user_id, audio in sink.audio_data.items():
-        if user_id == ctx.author.id:
-            audio: discord.sinks.core.AudioData = audio
-            print(user_id)
-            filepath = os.path.join("recordings", f"{ctx.author}.wav")
-            with open(filepath, "ab") as f:
-                f.write(audio.file.getvalue())
+    # the sink has already moved its spool files into the recording store
+    duration = await asyncio.to_thread(recording_store.duration, str(ctx.author))
+    print(f"Stopped recording {ctx.author}, {duration:.1f}s stored")
 
 # stops recording
-@bot.command()
+@commands.command()
 async def stop(ctx):
     if ctx.voice_client:
         ctx.voice_client.stop_recording()
@@ -141,85 +263,201 @@ async def stop(ctx):
     else:
         await ctx.send("not in a voice channel")
 
-@bot.command()
+@commands.command()
 async def train(ctx):
-    in_path = os.path.join("recordings", f"{ctx.author}.wav")
-    audio_length = get_audio_length_seconds(in_path)
-    if os.path.exists(in_path):
+    key = str(ctx.author)
+    # the store's lock is held while a recording is appended
+    if await asyncio.to_thread(recording_store.exists, key):
+        audio_length = await asyncio.to_thread(recording_store.speech_duration, key)
         if audio_length >= 300:
+            if ctx.author.id in training_tasks:
+                await ctx.send("A voice model is already being trained for you. Use `!cancel` to stop it.")
+                return
+            # registered before the first await, so a second !train is turned away
+            training_tasks[ctx.author.id] = asyncio.current_task()
             out_path = os.path.join("recordings", f"{ctx.author}")
-            split_audio_file(in_path, out_path, 10000)
-            uuid = train_voice_model(ctx.author, out_path)
+            try:
+                await asyncio.to_thread(split_audio_file, key, out_path)
+                uuid = await train_voice_model(ctx, ctx.author, out_path)
+            except QueueFull as e:
+                await ctx.send(f"{e}, try again later")
+                return
+            except asyncio.CancelledError:
+                await ctx.send(f"Cancelled voice model training for {ctx.author}")
+                return
+            finally:
+                del training_tasks[ctx.author.id]
             await ctx.send(f"A voice model has been trained for {ctx.author} with the id `{uuid}`")
         else:
-            await ctx.send(f"You do not have enough audio recorded. You currently have {audio_length} seconds recorded out of 300.")
+            await ctx.send(f"You do not have enough audio recorded. You currently have {audio_length:.1f} seconds of speech recorded out of 300.")
     else:
         await ctx.send("There is no audio data recorded for you. Please try using the `!listen` and `stop` commands to record training data for yourself. You must have at least 300 seconds of audio data.")
 
-def split_audio_file(input_file, output_dir, chunk_length=10000):
-    # Load the audio file
-    audio = AudioSegment.from_wav(input_file)
-
-    # Calculate the number of chunks
-    n_chunks = (len(audio) // chunk_length) + (1 if len(audio) % chunk_length > 0 else 0)
-
-    # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Split the audio and save the chunks
-    for i in range(n_chunks):
-        start_time = i * chunk_length
-        end_time = (i + 1) * chunk_length
-        chunk = audio[start_time:end_time]
-        chunk.export(os.path.join(output_dir, f"chunk_{i}.wav"), format="wav")
-        print(f"Saved chunk {i} to {output_dir}/chunk_{i}.wav")
-
-def get_audio_length_seconds(input_file):
-    audio = AudioSegment.from_wav(input_file)
-    return len(audio)/1000
+def split_audio_file(key, output_dir):
+    # Copy each stretch of recorded speech (up to 10 s, cut at pauses) into its own chunk_{i}.wav
+    for path in recording_store.split_speech(key, output_dir, workers=4):
+        print(f"Saved chunk {path}")
 
-def count_files_in_directory(directory_path):
+def list_chunks(directory_path):
+    # chunk_{i}.wav files in index order (the directory also holds transcripts)
     try:
-        with os.scandir(directory_path) as entries:
-            return sum(entry.is_file() for entry in entries)
+        names = [name for name in os.listdir(directory_path) if name.startswith("chunk_") and name.endswith(".wav")]
     except FileNotFoundError:
         print(f"The directory '{directory_path}' does not exist.")
-        return 0
-
-def train_voice_model(name, rec_dir):
-    response = Resemble.v2.voices.create(name)
-    voice = response['item']
-    voice_uuid = voice['uuid']
-
-    upload_recordings(voice_uuid, rec_dir)
-    response = Resemble.v2.voices.build(voice_uuid)
+        return []
+    names.sort(key=lambda name: int(name[len("chunk_"):-len(".wav")]))
+    return [os.path.join(directory_path, name) for name in names]
+
+# how much training audio is recorded
+@commands.command()
+async def recorded(ctx):
+    info = await asyncio.to_thread(recording_store.wav_info, str(ctx.author))
+    if info:
+        sessions = len(await asyncio.to_thread(recording_store.sessions, str(ctx.author)))
+        speech = await asyncio.to_thread(recording_store.speech_duration, str(ctx.author))
+        await ctx.send(f"You have {speech:.1f} seconds of speech recorded out of 300 ({info.duration:.1f} seconds in {sessions} sessions).")
+    else:
+        await ctx.send("There is no audio data recorded for you.")
+
+# cancel a running !train
+@commands.command()
+async def cancel(ctx):
+    task = training_tasks.get(ctx.author.id)
+    if task:
+        task.cancel()
+    else:
+        await ctx.send("You have no voice model training in progress")
+
+async def train_voice_model(ctx, name, rec_dir):
+    # resume the voice left by an interrupted !train for this directory
+    manifest = UploadManifest(rec_dir)
+    if manifest.voice_uuid is None:
+        response = await resemble.v2.voices.create(str(name))
+        voice = response.item
+        manifest.voice_uuid = voice['uuid']
+        manifest.save()
+    voice_uuid = manifest.voice_uuid
+
+    await upload_recordings(ctx, voice_uuid, rec_dir, manifest)
+    await resemble.v2.voices.build(voice_uuid)
+    manifest.clear()
     return voice_uuid
 
 
+async def upload_chunk(uuid, i, rec_path, text, manifest):
+    audio_hash = await asyncio.to_thread(file_hash, rec_path)
+    if audio_hash in manifest.uploaded:
+        return
+    emotion = 'neutral' # must find emotion of the voice being transcribed
+    recording = await uploader.create_recording(uuid, rec_path, f'recording_{i}', text, True, emotion)
+    manifest.uploaded[audio_hash] = recording['uuid']
+    manifest.save()
+
+
+async def upload_recordings(ctx, uuid, rec_dir, manifest):
+    # Delete uploaded recordings that are not from this directory's chunks
+    recordings = await uploader.list_recordings(uuid)
+    known = set(manifest.uploaded.values())
+    await asyncio.gather(*(
+        uploader.delete_recording(uuid, recording['uuid'])
+        for recording in recordings if recording['uuid'] not in known
+    ))
+    remote = {recording['uuid'] for recording in recordings}
+    manifest.uploaded = {h: r for h, r in manifest.uploaded.items() if r in remote}
+
+    # Transcribe every chunk once (cached as chunk_{i}.txt) off the event loop
+    chunk_paths = list_chunks(rec_dir)
+    status = await ctx.send(f"Transcribing {len(chunk_paths)} chunks...")
+
+    async def progress(done, total):
+        if done == total:
+            await edit_pacer.wait(ctx.channel.id)
+        elif edit_pacer.ready(ctx.channel.id):
+            edit_pacer.mark(ctx.channel.id)
+        else:
+            return
+        await status.edit(content=f"Transcribed {done}/{total} chunks")
 
+    # and upload each chunk as soon as its transcript is ready
+    uploads = []
+    accepting = True
+    def on_text(i, rec_path, text):
+        if accepting:
+            uploads.append(asyncio.ensure_future(upload_chunk(uuid, i, rec_path, text, manifest)))
 
-def upload_recordings(uuid, rec_dir):
-    # Delete all currently uploaded recordings
-    response = Resemble.v2.recordings.all(uuid, 1, 1000)
-    recordings = response['items']
-    for recording in recordings:
-        recording_uuid = recording['uuid']
-        response = Resemble.v2.recordings.delete(uuid, recording_uuid)
-
-    # Add all of the recordings saved in the given directory
-    recordings = count_files_in_directory(rec_dir)
-    for i in range(recordings):
-        rec_path = os.path.join(rec_dir, f'chunk_{i}.wav')
-        transcript_path = os.path.join(rec_dir, f'chunk_{i}.txt')
-        name = f'recording_{i}'
-        whisper_data = model.transcribe(rec_dir)
-        text = whisper_data['text']
-        is_active = True
-        emotion = 'neutral' # must find emotion of the voice being transcribed
-        with open(rec_path, 'rb') as file:
-            response = Resemble.v2.recordings.create(uuid, file, name, text, is_active, emotion)
-            recording = response['item']
-        with open(transcript_path, 'w+') as file:
-            file.write(text)
-
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+    try:
+        await transcribe_chunks(transcriber, chunk_paths, progress=progress, on_text=on_text)
+        await asyncio.gather(*uploads)
+    except BaseException:
+        for upload in uploads:
+            upload.cancel()
+        raise
+    finally:
+        # transcripts arriving after a cancel or failure are not uploaded
+        accepting = False
+    await edit_pacer.wait(ctx.channel.id)
+    await status.edit(content=f"Uploaded {len(chunk_paths)} chunks")
+
+
+def main():
+    # everything with side effects (keys, files, clients, threads) is set up
+    # here: transcription worker processes import this file too
+    global RESEMBLE_PROJECT_UUID, RESEMBLE_VOICE_UUID, RESEMBLE_SYN_SERVER_URL
+    global bot, response_cache, completions, scheduler, batcher, single_flight, edit_pacer
+    global transcriber, resemble, uploader, speech_detector, recording_store, opus_encoders, clip_cache
+
+    load_dotenv()
+    DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    RESEMBLE_API_KEY = os.getenv("RESEMBLE_API_KEY")
+    RESEMBLE_PROJECT_UUID = os.getenv("RESEMBLE_PROJECT_UUID")
+    RESEMBLE_VOICE_UUID = os.getenv("RESEMBLE_VOICE_UUID")
+    RESEMBLE_SYN_SERVER_URL = os.getenv("RESEMBLE_SYN_SERVER_URL")
+
+    bot = GPTBot(command_prefix="!", intents=intents)
+    bot.event(on_ready)
+    bot.event(on_message)
+    for command in (gpt, gptstats, join, leave, say, listen, stop, train, recorded, cancel):
+        bot.add_command(command)
+
+    # Set up OpenAI API
+    openai.api_key = OPENAI_API_KEY
+    # Set up Resemble API
+    Resemble.api_key(RESEMBLE_API_KEY)
+    if RESEMBLE_SYN_SERVER_URL:
+        Resemble.syn_server_url(RESEMBLE_SYN_SERVER_URL)
+    # Cache repeated prompts; only temperatures below max_temperature are cached
+    response_cache = ResponseCache(max_entries=1000, ttl=3600, max_temperature=0.6,
+                                   path=os.path.join("cache", "responses.json"))
+    # Set up async completion client (shares one aiohttp session)
+    completions = CompletionClient(engine="text-davinci-003", max_tokens=150, temperature=0.5,
+                                   cache=response_cache)
+    # Limit concurrent completion requests and share them fairly between servers and users
+    scheduler = FairScheduler(max_in_flight=4, max_guild_queue=20, max_user_queue=5)
+    # Send prompts arriving within window_ms of each other as one request, which
+    # takes a single scheduler slot
+    batcher = CompletionBatcher(completions, window_ms=25, max_batch=8, scheduler=scheduler)
+    # Share one in-flight completion between concurrent identical requests
+    single_flight = SingleFlight()
+    edit_pacer = EditPacer(edits=5, per=5.0)
+    # Set up Whisper transcription processes (shut down after 15 idle minutes)
+    transcriber = TranscriptionWorker("base", workers=2, max_queue=500, idle_shutdown=900)
+    # Resemble calls share one pooled aiohttp session and retry transient errors
+    resemble = AsyncResemble(max_connections=8, timeout=60, retries=4, backoff=1.0)
+    # Upload training chunks 4 at a time
+    uploader = RecordingUploader(resemble, parallelism=4)
+    # Per-user training audio: raw pcm log plus an index of recorded sessions,
+    # with speech detected so silence is neither counted nor uploaded
+    speech_detector = SpeechDetector(threshold_db=-45.0, max_gap_ms=1000, min_chunk_ms=1000, max_chunk_ms=10000)
+    recording_store = RecordingStore("recordings", speech_detector=speech_detector)
+    # Speech is encoded to opus once on shared threads, so voice players only
+    # send packets
+    opus_encoders = OpusEncoderPool(workers=2)
+    # Synthesized lines kept as Ogg/Opus, least recently played evicted first
+    clip_cache = ClipCache(os.path.join("cache", "clips"), max_bytes=256 << 20)
+
+    bot.run(DISCORD_TOKEN)
+
+
+if __name__ == "__main__":
+    main()
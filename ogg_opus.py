@@ -0,0 +1,107 @@
+import io
+import os
+import random
+import struct
+import tempfile
+import zlib
+
+from discord.oggparse import OggStream
+
+# https://tools.ietf.org/html/rfc3533 and https://tools.ietf.org/html/rfc7845
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+OPUS_HEAD = struct.Struct("<8sBBHIhB")
+BEGIN_OF_STREAM = 0x02
+END_OF_STREAM = 0x04
+# samples per channel in each 20 ms packet at 48 kHz
+PACKET_SAMPLES = 960
+
+# each byte with its bits reversed, to compute the ogg crc with zlib
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def ogg_crc(data):
+    # the ogg checksum is crc32 without bit reflection, initial value or final
+    # xor; zlib's reflected crc32 gives it for the bit reversed data once its
+    # initial value and final xor are cancelled with the crc of as many zeros
+    crc = zlib.crc32(data.translate(_REVERSED_BITS)) ^ zlib.crc32(bytes(len(data)))
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+class OggOpusWriter:
+    # writes opus packets to a file object as an Ogg/Opus stream, several
+    # packets to a page
+    def __init__(self, f, channels=2, sample_rate=48000, packets_per_page=50, vendor="discord bot"):
+        self.f = f
+        self.serial = random.getrandbits(32)
+        self.page_number = 0
+        self.granule = 0
+        self.packets_per_page = packets_per_page
+        self.packets = []
+        self._page([OPUS_HEAD.pack(b"OpusHead", 1, channels, 0, sample_rate, 0, 0)], 0, BEGIN_OF_STREAM)
+        vendor = vendor.encode("utf-8")
+        self._page([b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)], 0)
+
+    def write(self, packet, samples=PACKET_SAMPLES):
+        self.packets.append(packet)
+        self.granule += samples
+        if len(self.packets) >= self.packets_per_page:
+            self.flush()
+
+    def flush(self, flags=0):
+        if self.packets or flags:
+            self._page(self.packets, self.granule, flags)
+            self.packets = []
+
+    def close(self):
+        self.flush(END_OF_STREAM)
+
+    def _page(self, packets, granule, flags=0):
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b"\xff" * (len(packet) // 255) + bytes((len(packet) % 255,))
+        if len(lacing) > 255:
+            # too many segments for one page, split it
+            half = len(packets) // 2
+            self._page(packets[:half], granule - PACKET_SAMPLES * (len(packets) - half), flags & BEGIN_OF_STREAM)
+            self._page(packets[half:], granule, flags & ~BEGIN_OF_STREAM)
+            return
+        page = bytearray(PAGE_HEADER.pack(b"OggS", 0, flags, granule, self.serial, self.page_number, 0, len(lacing)))
+        page += lacing
+        for packet in packets:
+            page += packet
+        struct.pack_into("<I", page, 22, ogg_crc(bytes(page)))
+        self.f.write(page)
+        self.page_number += 1
+
+
+def write_ogg_opus(path, packets):
+    # written to a temporary file of its own and moved into place, so
+    # concurrent writers of the same path never interleave
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = OggOpusWriter(f)
+            for packet in packets:
+                writer.write(packet)
+            writer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def iter_opus_packets(f):
+    # the audio packets of an Ogg/Opus stream, without its two header packets
+    packets = OggStream(f).iter_packets()
+    for packet in packets:
+        if not packet.startswith((b"OpusHead", b"OpusTags")):
+            yield packet
+            break
+    yield from packets
+
+
+def read_ogg_opus(data):
+    return list(iter_opus_packets(io.BytesIO(data)))
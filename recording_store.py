@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+from wav_files import WavInfo, read_wav_info, wav_header, write_wav_chunks
+
+
+class RecordingStore:
+    # keeps each user's training audio as an append-only raw pcm log
+    # ({key}.pcm) plus one json line per recorded session ({key}.sessions),
+    # so appending costs only the new session and durations come from the index.
+    # With a speech detector each session also records its seconds of speech
+    def __init__(self, root="recordings", speech_detector=None):
+        self.root = root
+        self.speech_detector = speech_detector
+        self.lock = threading.Lock()
+        self.sessions_cache = {}
+        os.makedirs(root, exist_ok=True)
+
+    def pcm_path(self, key):
+        return os.path.join(self.root, f"{key}.pcm")
+
+    def index_path(self, key):
+        return os.path.join(self.root, f"{key}.sessions")
+
+    def wav_path(self, key):
+        return os.path.join(self.root, f"{key}.wav")
+
+    def sessions(self, key):
+        with self.lock:
+            return list(self._sessions(key))
+
+    def _sessions(self, key):
+        sessions = self.sessions_cache.get(key)
+        if sessions is None:
+            self._import_legacy_wav(key)
+            sessions = []
+            try:
+                with open(self.index_path(key), "r") as f:
+                    sessions = [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                pass
+            self.sessions_cache[key] = sessions
+        return sessions
+
+    def exists(self, key):
+        return bool(self.sessions(key))
+
+    def append(self, key, data, sample_rate, channels, sample_width, started=None, ended=None):
+        # data is a binary file object positioned at the start of the pcm
+        with self.lock:
+            sessions = self._sessions(key)
+            if sessions:
+                last = sessions[-1]
+                if (last["sample_rate"], last["channels"], last["sample_width"]) != (sample_rate, channels, sample_width):
+                    raise ValueError(f"recording format for {key} does not match earlier sessions")
+
+            with open(self.pcm_path(key), "ab") as f:
+                offset = f.tell()
+                shutil.copyfileobj(data, f)
+                length = f.tell() - offset
+            length -= length % (channels * sample_width)
+            if not length:
+                return None
+
+            ended = ended if ended is not None else time.time()
+            duration = length / (sample_rate * channels * sample_width)
+            session = {
+                "offset": offset,
+                "length": length,
+                "started": started if started is not None else ended - duration,
+                "ended": ended,
+                "sample_rate": sample_rate,
+                "channels": channels,
+                "sample_width": sample_width,
+            }
+            if self.speech_detector is not None:
+                session["speech"] = self.speech_detector.speech_seconds(
+                    self.pcm_path(key), offset, length, sample_rate, channels, sample_width)
+            with open(self.index_path(key), "a") as f:
+                f.write(json.dumps(session) + "\n")
+            sessions.append(session)
+            return session
+
+    def wav_info(self, key):
+        sessions = self.sessions(key)
+        if not sessions:
+            return None
+        first = sessions[0]
+        segments = [(s["offset"], s["length"]) for s in sessions]
+        return WavInfo(first["sample_rate"], first["channels"], first["sample_width"], segments)
+
+    def duration(self, key):
+        info = self.wav_info(key)
+        return info.duration if info else 0.0
+
+    def speech_duration(self, key):
+        # sessions indexed before speech detection was enabled are measured
+        # once and remembered in memory
+        if self.speech_detector is None:
+            return self.duration(key)
+        total = 0.0
+        with self.lock:
+            for session in self._sessions(key):
+                if session.get("speech") is None:
+                    session["speech"] = self.speech_detector.speech_seconds(
+                        self.pcm_path(key), session["offset"], session["length"],
+                        session["sample_rate"], session["channels"], session["sample_width"])
+                total += session["speech"]
+        return total
+
+    def split_speech(self, key, output_dir, workers=4, chunk_length=10000):
+        # one chunk_{i}.wav per stretch of speech, cut at pauses; without a
+        # speech detector each session is cut into chunk_length ms pieces
+        info = self.wav_info(key)
+        if info is None:
+            return []
+        size = info.sample_rate * chunk_length // 1000 * info.block_align
+        chunks = []
+        for session in self.sessions(key):
+            if self.speech_detector is None:
+                start, end = session["offset"], session["offset"] + session["length"]
+                chunks.extend([(lo, min(lo + size, end))] for lo in range(start, end, size))
+                continue
+            chunks.extend([(lo, hi)] for lo, hi in self.speech_detector.chunks(
+                self.pcm_path(key), session["offset"], session["length"],
+                session["sample_rate"], session["channels"], session["sample_width"]))
+        return write_wav_chunks(self.pcm_path(key), output_dir, info, chunks, workers)
+
+    def compact(self, key, out_path=None):
+        # writes every session into one valid wav file
+        info = self.wav_info(key)
+        if info is None:
+            return None
+        out_path = out_path or self.wav_path(key)
+        with open(self.pcm_path(key), "rb") as src, open(out_path, "wb") as out:
+            out.write(wav_header(info.data_size, info.sample_rate, info.channels, info.sample_width))
+            for offset, size in info.segments:
+                src.seek(offset)
+                _copy_range(src, out, size)
+        return out_path
+
+    def _import_legacy_wav(self, key):
+        # recordings made before the store existed were wav files appended to
+        # {key}.wav; move their audio into the log the first time it is read
+        legacy_path = self.wav_path(key)
+        if not os.path.exists(legacy_path) or os.path.exists(self.index_path(key)):
+            return
+        info = read_wav_info(legacy_path)
+        block_align = info.block_align
+        with open(legacy_path, "rb") as src, open(self.pcm_path(key), "wb") as out, \
+                open(self.index_path(key), "w") as index:
+            mtime = os.path.getmtime(legacy_path)
+            for offset, size in info.segments:
+                size -= size % block_align
+                start = out.tell()
+                src.seek(offset)
+                _copy_range(src, out, size)
+                index.write(json.dumps({
+                    "offset": start,
+                    "length": size,
+                    "started": None,
+                    "ended": mtime,
+                    "sample_rate": info.sample_rate,
+                    "channels": info.channels,
+                    "sample_width": info.sample_width,
+                }) + "\n")
+        os.replace(legacy_path, f"{legacy_path}.imported")
+        print(f"Imported {legacy_path} into the recording store")
+
+
+def _copy_range(src, out, size, block=1 << 20):
+    while size > 0:
+        data = src.read(min(block, size))
+        if not data:
+            break
+        out.write(data)
+        size -= len(data)
@@ -0,0 +1,312 @@
+import asyncio
+import os
+import random
+
+import aiohttp
+from resemble import V2_STREAMING_BUFFER_SIZE, Resemble
+
+from tts_stream import StreamDecoder
+
+# statuses worth retrying, everything else is raised straight away
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# statuses that say a request was turned away without being carried out, the
+# only ones a request that must not run twice is retried on
+REFUSED_STATUSES = {429, 503}
+
+
+class ResembleError(Exception):
+    def __init__(self, message, status=None, response=None):
+        super().__init__(message)
+        self.status = status
+        self.response = response
+
+
+class ResembleResponse:
+    # the json body of an api response with its common fields as attributes;
+    # indexing reads the json itself, so code written for the dicts the
+    # Resemble SDK returns keeps working
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __repr__(self):
+        return f"ResembleResponse({self.data!r})"
+
+    @property
+    def success(self):
+        return self.get("success", False)
+
+    @property
+    def item(self):
+        return self.get("item")
+
+    @property
+    def items(self):
+        return self.get("items", [])
+
+    @property
+    def page(self):
+        return self.get("page", 1)
+
+    @property
+    def num_pages(self):
+        return self.get("num_pages", 1)
+
+    @property
+    def message(self):
+        return self.get("message")
+
+
+class AsyncResemble:
+    # async counterpart of resemble.Resemble with the same api shape
+    # (client.v2.voices.create(...) and so on, awaited) and the same key and
+    # urls, set through Resemble.api_key / base_url / syn_server_url. Every
+    # call shares one aiohttp session with a keep-alive connection pool, has a
+    # timeout, and is retried with exponential backoff on connection errors
+    # and transient statuses. Requests that are not idempotent (POSTs, unless
+    # the caller says otherwise) are only retried when the connection could
+    # not be made or the server refused them, since a timeout or a 5xx may
+    # come after the voice, build or recording was already created
+    def __init__(self, max_connections=20, timeout=60, connect_timeout=10, retries=4, backoff=1.0):
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        # a stream lasts as long as the speech, only a stalled read times out
+        self.stream_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.v2 = _V2(self)
+
+    def _get_session(self):
+        # created lazily so the session is bound to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    @staticmethod
+    def _headers():
+        return {"Authorization": Resemble._headers["Authorization"]}
+
+    @staticmethod
+    def _syn_server_headers():
+        return {"x-access-token": Resemble._syn_server_headers["x-access-token"]}
+
+    async def request(self, method, endpoint, *, json=None, params=None, files=None, data=None, idempotent=None):
+        url = Resemble.endpoint("v2", endpoint)
+        if params:
+            params = {k: v for k, v in params.items() if v is not None}
+        if idempotent is None:
+            idempotent = method != "POST"
+        retry_statuses = RETRY_STATUSES if idempotent else REFUSED_STATUSES
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_session().request(
+                        method, url, headers=self._headers(), json=json, params=params,
+                        data=_form(files, data) if files else data) as r:
+                    if r.status not in retry_statuses:
+                        return await _read_response(r, method, url)
+                    error = ResembleError(f"{r.status} from {method} {url}", r.status)
+            except aiohttp.ClientConnectorError as e:
+                # the connection was never made, so nothing was sent
+                error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not idempotent:
+                    raise
+                error = e
+            if attempt == self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+            print(f"Retrying {method} {url} in {delay:.1f}s after: {error!r}")
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+def _form(files, fields):
+    # built for every attempt, a sent form cannot be sent again
+    form = aiohttp.FormData()
+    for key, value in (fields or {}).items():
+        form.add_field(key, value)
+    for key, (filename, content, content_type) in files.items():
+        form.add_field(key, content, filename=filename, content_type=content_type)
+    return form
+
+
+async def _read_response(r, method, url):
+    try:
+        body = await r.json(content_type=None)
+    except ValueError:
+        body = {"message": await r.text()}
+    response = ResembleResponse(body if isinstance(body, dict) else {"items": body})
+    if r.status >= 400 or response.get("success") is False:
+        raise ResembleError(f"{r.status} from {method} {url}: {response.message}", r.status, response)
+    return response
+
+
+def _options(**options):
+    return {k: v for k, v in options.items() if v is not None}
+
+
+class _V2:
+    def __init__(self, client):
+        self.projects = _ProjectsV2(client)
+        self.voices = _VoicesV2(client)
+        self.clips = _ClipsV2(client)
+        self.recordings = _RecordingsV2(client)
+
+
+class _ProjectsV2:
+    def __init__(self, client):
+        self.client = client
+
+    async def all(self, page, page_size=None):
+        return await self.client.request("GET", "projects", params={"page": page, "page_size": page_size})
+
+    async def create(self, name, description, is_public=False, is_collaborative=False, is_archived=False):
+        return await self.client.request("POST", "projects", json={
+            "name": name, "description": description, "is_public": is_public,
+            "is_collaborative": is_collaborative, "is_archived": is_archived,
+        })
+
+    async def update(self, uuid, name, description, is_public=False, is_collaborative=False, is_archived=False):
+        return await self.client.request("PUT", f"projects/{uuid}", json={
+            "name": name, "description": description, "is_public": is_public,
+            "is_collaborative": is_collaborative, "is_archived": is_archived,
+        })
+
+    async def get(self, uuid):
+        return await self.client.request("GET", f"projects/{uuid}")
+
+    async def delete(self, uuid):
+        return await self.client.request("DELETE", f"projects/{uuid}")
+
+
+class _VoicesV2:
+    def __init__(self, client):
+        self.client = client
+
+    async def all(self, page, page_size=None):
+        return await self.client.request("GET", "voices", params={"page": page, "page_size": page_size})
+
+    async def create(self, name, dataset_url=None, callback_uri=None):
+        return await self.client.request("POST", "voices", json=_options(
+            name=name, dataset_url=dataset_url, callback_uri=callback_uri))
+
+    async def update(self, uuid, name, dataset_url=None):
+        return await self.client.request("PUT", f"voices/{uuid}", json=_options(name=name, dataset_url=dataset_url))
+
+    async def build(self, uuid):
+        return await self.client.request("POST", f"voices/{uuid}/build")
+
+    async def get(self, uuid):
+        return await self.client.request("GET", f"voices/{uuid}")
+
+    async def delete(self, uuid):
+        return await self.client.request("DELETE", f"voices/{uuid}")
+
+
+class _ClipsV2:
+    def __init__(self, client):
+        self.client = client
+
+    async def all(self, project_uuid, page, page_size=None):
+        return await self.client.request("GET", f"projects/{project_uuid}/clips",
+                                         params={"page": page, "page_size": page_size})
+
+    async def create_sync(self, project_uuid, voice_uuid, body, title=None, sample_rate=None, output_format=None,
+                          precision=None, include_timestamps=None, is_public=None, is_archived=None, raw=None):
+        return await self.client.request("POST", f"projects/{project_uuid}/clips", json=_options(
+            voice_uuid=voice_uuid, body=body, title=title, sample_rate=sample_rate, output_format=output_format,
+            precision=precision, include_timestamps=include_timestamps, is_public=is_public,
+            is_archived=is_archived, raw=raw))
+
+    async def create_async(self, project_uuid, voice_uuid, callback_uri, body, title=None, sample_rate=None,
+                           output_format=None, precision=None, include_timestamps=None, is_public=None,
+                           is_archived=None):
+        return await self.client.request("POST", f"projects/{project_uuid}/clips", json=_options(
+            voice_uuid=voice_uuid, body=body, title=title, sample_rate=sample_rate, output_format=output_format,
+            precision=precision, include_timestamps=include_timestamps, is_public=is_public,
+            is_archived=is_archived, callback_uri=callback_uri))
+
+    async def update_async(self, project_uuid, clip_uuid, voice_uuid, callback_uri, body, title=None,
+                           sample_rate=None, output_format=None, precision=None, include_timestamps=None,
+                           is_public=None, is_archived=None):
+        return await self.client.request("PUT", f"projects/{project_uuid}/clips/{clip_uuid}", json=_options(
+            voice_uuid=voice_uuid, body=body, title=title, sample_rate=sample_rate, output_format=output_format,
+            precision=precision, include_timestamps=include_timestamps, is_public=is_public,
+            is_archived=is_archived, callback_uri=callback_uri))
+
+    async def stream(self, project_uuid, voice_uuid, body, buffer_size=V2_STREAMING_BUFFER_SIZE,
+                     ignore_wav_header=True, sample_rate=None):
+        # yields buffer_size memoryviews of pcm as the speech is synthesized,
+        # each valid until the next one is requested. Not retried, since the
+        # audio may already have been played
+        options = _options(project_uuid=project_uuid, voice_uuid=voice_uuid, data=body, sample_rate=sample_rate)
+        url = Resemble.syn_server_endpoint("stream")
+        async with self.client._get_session().post(url, headers=self.client._syn_server_headers(), json=options,
+                                                   timeout=self.client.stream_timeout) as r:
+            if r.status >= 400:
+                await _read_response(r, "POST", url)
+            decoder = StreamDecoder(buffer_size, ignore_wav_header)
+            async for chunk in r.content.iter_any():
+                decoder.decode_chunk(chunk)
+                buffer = decoder.flush_buffer()
+                while buffer is not None:
+                    yield buffer
+                    buffer = decoder.flush_buffer()
+            buffer = decoder.flush_buffer(force=True)
+            if buffer is not None:
+                yield buffer
+
+    async def get(self, project_uuid, clip_uuid):
+        return await self.client.request("GET", f"projects/{project_uuid}/clips/{clip_uuid}")
+
+    async def delete(self, project_uuid, clip_uuid):
+        return await self.client.request("DELETE", f"projects/{project_uuid}/clips/{clip_uuid}")
+
+
+class _RecordingsV2:
+    def __init__(self, client):
+        self.client = client
+
+    async def all(self, voice_uuid, page, page_size=None):
+        return await self.client.request("GET", f"voices/{voice_uuid}/recordings",
+                                         params={"page": page, "page_size": page_size})
+
+    async def create(self, voice_uuid, file, name, text, is_active, emotion, filename=None):
+        # file is a binary file object or the audio bytes; it is read up front
+        # so a retry sends the whole file again. The fields are sent as form
+        # fields next to the file (the SDK sends them as json, which requests
+        # drops from a multipart request)
+        filename = filename or os.path.basename(getattr(file, "name", "recording.wav"))
+        audio = file if isinstance(file, (bytes, bytearray)) else file.read()
+        return await self.client.request("POST", f"voices/{voice_uuid}/recordings", files={
+            "file": (filename, bytes(audio), "audio/wav"),
+        }, data={
+            "name": name,
+            "text": text,
+            "is_active": "true" if is_active else "false",
+            "emotion": emotion,
+        })
+
+    async def update(self, voice_uuid, recording_uuid, name, text, is_active, emotion):
+        return await self.client.request("PUT", f"voices/{voice_uuid}/recordings/{recording_uuid}", json={
+            "name": name, "text": text, "is_active": is_active, "emotion": emotion,
+        })
+
+    async def get(self, voice_uuid, recording_uuid):
+        return await self.client.request("GET", f"voices/{voice_uuid}/recordings/{recording_uuid}")
+
+    async def delete(self, voice_uuid, recording_uuid):
+        return await self.client.request("DELETE", f"voices/{voice_uuid}/recordings/{recording_uuid}")
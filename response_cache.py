@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+# request options that do not change the generated text
+IGNORED_PARAMS = ("request_timeout", "stream")
+
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+
+def request_key(params):
+    data = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+    data["prompt"] = normalize_prompt(data["prompt"])
+    encoded = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    # LRU cache of completion text keyed on the normalized prompt, engine and
+    # sampling params; only low temperature requests are cached since the
+    # others are expected to vary between calls
+    def __init__(self, max_entries=1000, ttl=3600, max_temperature=0.3, path=None, save_every=20):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.path = path
+        self.save_every = save_every
+        self.entries = OrderedDict()  # key -> (expires, text)
+        self.hits = 0
+        self.misses = 0
+        self._unsaved = 0
+        if path:
+            self.load()
+
+    def key(self, params):
+        if params.get("temperature", 1) >= self.max_temperature:
+            return None
+        return request_key(params)
+
+    def get(self, params):
+        key = self.key(params)
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, params, text):
+        key = self.key(params)
+        if key is None or not text:
+            return
+        self.entries[key] = (time.time() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        self._unsaved += 1
+        if self.path and self._unsaved >= self.save_every:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        now = time.time()
+        for key, (expires, text) in entries:
+            if expires > now:
+                self.entries[key] = (expires, text)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
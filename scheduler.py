@@ -0,0 +1,161 @@
+import asyncio
+import time
+from collections import deque
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TimingStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class _GuildQueue:
+    def __init__(self, vtime):
+        self.vtime = vtime
+        self.users = {}  # user id -> deque of waiting futures
+        self.order = deque()  # user ids with waiting requests, served round robin
+        self.size = 0
+
+
+class FairScheduler:
+    # caps the number of in-flight calls and hands free slots out fairly:
+    # guilds are picked by lowest virtual time (advanced by 1/weight per
+    # request served) and users inside a guild are served round robin
+    def __init__(self, max_in_flight=4, max_guild_queue=20, max_user_queue=5, weights=None):
+        self.max_in_flight = max_in_flight
+        self.max_guild_queue = max_guild_queue
+        self.max_user_queue = max_user_queue
+        self.weights = weights or {}
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.clock = 0.0
+        self.guilds = {}
+        self.wait_time = TimingStats()
+        self.service_time = TimingStats()
+
+    async def run(self, fn, *args, guild_id=None, user_id=None, **kwargs):
+        await self._acquire(guild_id, user_id)
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self.service_time.add(time.perf_counter() - start)
+            self._release()
+
+    async def _acquire(self, guild_id, user_id):
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.wait_time.add(0.0)
+            return
+
+        guild = self.guilds.get(guild_id)
+        user = guild.users.get(user_id) if guild else None
+        if guild and guild.size >= self.max_guild_queue:
+            self.rejected += 1
+            raise QueueFull("too many requests queued for this server")
+        if user and len(user) >= self.max_user_queue:
+            self.rejected += 1
+            raise QueueFull("too many requests queued for this user")
+
+        if guild is None:
+            guild = self.guilds[guild_id] = _GuildQueue(self.clock)
+        if user is None:
+            user = guild.users[user_id] = deque()
+            guild.order.append(user_id)
+
+        waiter = asyncio.get_running_loop().create_future()
+        user.append(waiter)
+        guild.size += 1
+        self.queued += 1
+
+        enqueued = time.perf_counter()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted just before the cancellation landed
+                self._release()
+            else:
+                self._remove(guild_id, user_id, waiter)
+            raise
+        self.wait_time.add(time.perf_counter() - enqueued)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self.queued:
+            guild_id = min(self.guilds, key=lambda g: self.guilds[g].vtime)
+            guild = self.guilds[guild_id]
+
+            user_id = guild.order.popleft()
+            user = guild.users[user_id]
+            waiter = user.popleft()
+            if user:
+                guild.order.append(user_id)
+            else:
+                del guild.users[user_id]
+
+            guild.size -= 1
+            self.queued -= 1
+            if waiter.done():
+                # cancelled, its task has not run _remove yet
+                if not guild.size:
+                    del self.guilds[guild_id]
+                continue
+            guild.vtime += 1 / self.weights.get(guild_id, 1)
+            self.clock = guild.vtime
+            if not guild.size:
+                del self.guilds[guild_id]
+
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _remove(self, guild_id, user_id, waiter):
+        # the waiter may already have been popped (and skipped) by _dispatch
+        guild = self.guilds.get(guild_id)
+        user = guild.users.get(user_id) if guild else None
+        if user is None or waiter not in user:
+            return
+        user.remove(waiter)
+        guild.size -= 1
+        self.queued -= 1
+        if not user:
+            del guild.users[user_id]
+            guild.order.remove(user_id)
+        if not guild.size:
+            del self.guilds[guild_id]
+
+    def queue_length(self, guild_id=None):
+        if guild_id is None:
+            return self.queued
+        guild = self.guilds.get(guild_id)
+        return guild.size if guild else 0
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "served": self.service_time.count,
+            "mean_wait": self.wait_time.mean,
+            "max_wait": self.wait_time.max,
+            "mean_service": self.service_time.mean,
+            "max_service": self.service_time.max,
+        }
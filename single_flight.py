@@ -0,0 +1,33 @@
+import asyncio
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one running task; the task is
+    # shielded so a cancelled caller does not cancel it for everyone else
+    def __init__(self):
+        self.flights = {}
+        self.shared = 0
+
+    def __contains__(self, key):
+        return key in self.flights
+
+    async def run(self, key, fn, *args, **kwargs):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self.flights[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    async def wait(self, key):
+        self.shared += 1
+        return await asyncio.shield(self.flights[key])
+
+    def _finish(self, key, task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        if not task.cancelled():
+            # mark the exception as retrieved in case every caller went away
+            task.exception()
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class EditPacer:
+    # discord buckets message edits per channel (5 per 5 seconds), so every
+    # stream in a channel shares one schedule of allowed edit times
+    def __init__(self, edits=5, per=5.0):
+        self.interval = per / edits
+        self.next_edit = {}
+
+    def ready(self, channel_id):
+        return time.monotonic() >= self.next_edit.get(channel_id, 0.0)
+
+    def mark(self, channel_id):
+        now = time.monotonic()
+        self.next_edit[channel_id] = max(now, self.next_edit.get(channel_id, 0.0)) + self.interval
+
+    async def wait(self, channel_id):
+        delay = self.next_edit.get(channel_id, 0.0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.mark(channel_id)
+
+
+async def stream_reply(send, chunks, pacer, channel_id):
+    # sends the reply as soon as the first text arrives, then edits it with
+    # everything received since the last edit whenever the channel allows it
+    message = None
+    text = ""
+    shown = ""
+    async for chunk in chunks:
+        text += chunk
+        visible = text.strip()[:MAX_MESSAGE_LENGTH]
+        if not visible or visible == shown:
+            continue
+        if message is None:
+            message = await send(visible)
+            shown = visible
+        elif pacer.ready(channel_id):
+            pacer.mark(channel_id)
+            await message.edit(content=visible)
+            shown = visible
+
+    final = text.strip()[:MAX_MESSAGE_LENGTH]
+    if message is None:
+        await send(final or "...")
+    elif final != shown:
+        await pacer.wait(channel_id)
+        await message.edit(content=final)
+    return final
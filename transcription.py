@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from scheduler import QueueFull
+
+
+class WhisperModel:
+    # loads the whisper model on first use and keeps that one instance; whisper
+    # (and torch with it) is only imported here, by the worker processes
+    def __init__(self, name="base"):
+        self.name = name
+        self.model = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def use(self):
+        with self.lock:
+            if self.model is None:
+                import whisper
+                start = time.perf_counter()
+                self.model = whisper.load_model(self.name)
+                print(f"Loaded whisper model '{self.name}' in {time.perf_counter() - start:.1f}s")
+        yield self.model
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def transcript_path(chunk_path):
+    return os.path.splitext(chunk_path)[0] + ".txt"
+
+
+def _load_index(index_path):
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _read_cached(chunk_paths, index):
+    texts = []
+    for path in chunk_paths:
+        text_path = transcript_path(path)
+        if index.get(os.path.basename(path)) == file_hash(path) and os.path.exists(text_path):
+            with open(text_path, "r") as f:
+                texts.append(f.read())
+        else:
+            texts.append(None)
+    return texts
+
+
+def _save_transcript(index_path, index, lock, path, text):
+    with open(transcript_path(path), "w") as f:
+        f.write(text)
+    audio_hash = file_hash(path)
+    with lock:
+        index[os.path.basename(path)] = audio_hash
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+
+
+async def transcribe_chunks(worker, chunk_paths, progress=None, on_text=None, priority=10,
+                            index_name="transcripts.json"):
+    # transcribes every chunk exactly once; chunk_{i}.txt is reused as long as
+    # the audio hash recorded in the directory's index still matches. Each
+    # transcript is saved as soon as it arrives, so a cancelled or failed run
+    # keeps the ones already done. on_text(i, path, text) is called as soon as
+    # each chunk's text is known
+    if not chunk_paths:
+        return []
+    index_path = os.path.join(os.path.dirname(chunk_paths[0]), index_name)
+    index = await asyncio.to_thread(_load_index, index_path)
+    texts = await asyncio.to_thread(_read_cached, chunk_paths, index)
+
+    if on_text is not None:
+        for i, (path, text) in enumerate(zip(chunk_paths, texts)):
+            if text is not None:
+                on_text(i, path, text)
+
+    missing_indices = [i for i, text in enumerate(texts) if text is None]
+    missing = [chunk_paths[i] for i in missing_indices]
+    if missing:
+        loop = asyncio.get_running_loop()
+        lock = threading.Lock()
+        saves = []
+        def on_result(j, text):
+            saves.append(loop.run_in_executor(None, _save_transcript, index_path, index, lock, missing[j], text))
+            if on_text is not None:
+                on_text(missing_indices[j], missing[j], text)
+        job = worker.submit(missing, priority=priority, progress=progress, on_result=on_result)
+        try:
+            results = await job.wait()
+            # progress updates still running land before the caller's next one
+            await job.wait_progress()
+        except BaseException:
+            job.cancel()
+            raise
+        finally:
+            await asyncio.gather(*saves)
+        transcribed = iter(results)
+        texts = [text if text is not None else next(transcribed) for text in texts]
+    return texts
+
+
+# set in each pool process by _init_worker
+_worker_model = None
+
+
+def _init_worker(model_name):
+    global _worker_model
+    _worker_model = WhisperModel(model_name)
+    with _worker_model.use():
+        pass
+
+
+def _transcribe_in_worker(path):
+    with _worker_model.use() as model:
+        return model.transcribe(path)["text"].strip()
+
+
+class TranscriptionJob:
+    def __init__(self, paths, priority, progress, on_result):
+        self.paths = paths
+        self.priority = priority
+        self.progress = progress
+        self.on_result = on_result
+        self.results = [None] * len(paths)
+        self.completed = 0
+        self.cancelled = False
+        self.future = asyncio.get_running_loop().create_future()
+        self.progress_tasks = []
+
+    async def wait(self):
+        return await self.future
+
+    async def wait_progress(self):
+        # failures are reported by _progress_done
+        await asyncio.gather(*self.progress_tasks, return_exceptions=True)
+
+    def cancel(self):
+        self.cancelled = True
+        if not self.future.done():
+            self.future.cancel()
+        for task in self.progress_tasks:
+            task.cancel()
+
+    def _complete(self, i, text):
+        if self.cancelled:
+            # a chunk that was already being transcribed when the job was
+            # cancelled or failed; nobody is waiting for it
+            return
+        self.results[i] = text
+        self.completed += 1
+        if self.on_result is not None:
+            self.on_result(i, text)
+        if self.progress is not None:
+            task = asyncio.ensure_future(self.progress(self.completed, len(self.paths)))
+            task.add_done_callback(_progress_done)
+            self.progress_tasks.append(task)
+        if self.completed == len(self.paths) and not self.future.done():
+            self.future.set_result(self.results)
+
+    def _fail(self, error):
+        self.cancelled = True
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+def _progress_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Transcription progress update failed: {task.exception()!r}")
+
+
+class TranscriptionWorker:
+    # runs whisper in a pool of processes (one preloaded model each) so speech
+    # recognition never competes with the event loop; files are queued by
+    # priority (lower first) and the pool shuts down after idle_shutdown seconds
+    def __init__(self, model_name="base", workers=2, max_queue=500, idle_shutdown=900):
+        self.model_name = model_name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.idle_shutdown = idle_shutdown
+        self.pool = None
+        self.queue = None
+        self.dispatchers = []
+        self.pending = 0
+        self.running = 0
+        self.last_used = 0.0
+        self._counter = itertools.count()
+        self._idle_handle = None
+
+    def _ensure_started(self):
+        if self.pool is not None:
+            return
+        # spawned on every platform: forking copies the event loop's threads
+        # and clients, and a spawned worker only imports what it needs
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(self.model_name,))
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        self.dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.workers)]
+
+    def warm_up(self):
+        # spawn the processes now so their models load before the first job
+        self._ensure_started()
+        for _ in range(self.workers):
+            self.pool.submit(int)
+        self._schedule_shutdown()
+
+    def submit(self, paths, priority=10, progress=None, on_result=None):
+        if self.pending + len(paths) > self.max_queue:
+            raise QueueFull("the transcription queue is full")
+        self._ensure_started()
+        job = TranscriptionJob(paths, priority, progress, on_result)
+        for i in range(len(paths)):
+            self.queue.put_nowait((priority, next(self._counter), job, i))
+        self.pending += len(paths)
+        return job
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job, i = await self.queue.get()
+            self.pending -= 1
+            if job.cancelled:
+                continue
+            self.running += 1
+            try:
+                text = await loop.run_in_executor(self.pool, _transcribe_in_worker, job.paths[i])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job._fail(e)
+            else:
+                job._complete(i, text)
+            finally:
+                self.running -= 1
+                self.last_used = time.monotonic()
+                self._schedule_shutdown()
+
+    def _schedule_shutdown(self):
+        if self.idle_shutdown is None:
+            return
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        self._idle_handle = asyncio.get_running_loop().call_later(self.idle_shutdown, self._shutdown_if_idle)
+
+    def _shutdown_if_idle(self):
+        if self.pending or self.running:
+            return
+        print("Shutting down idle transcription workers")
+        self.shutdown()
+
+    def shutdown(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.dispatchers = []
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,168 @@
+import requests
+from resemble import Resemble
+
+from wav_files import CHUNK_HEADER
+
+
+def fixed_header(size):
+    # header parser for streams with a header of known length
+    def parse(data):
+        return size if len(data) >= size else None
+    return parse
+
+
+def wav_header_size(data):
+    # header parser for streamed wav files: walks the RIFF chunks up to the
+    # start of the data chunk, so extra chunks before it are skipped too.
+    # Returns None until enough of the header has arrived
+    if len(data) < 12:
+        return None
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("stream is not a wav file")
+    offset = 12
+    while len(data) >= offset + 8:
+        chunk_id, size = CHUNK_HEADER.unpack_from(data, offset)
+        offset += 8
+        if chunk_id == b"data":
+            return offset
+        offset += size + (size & 1)
+    return None
+
+
+class RingBuffer:
+    # fifo of bytes in a fixed bytearray that doubles when full; data is
+    # written once and read back as memoryviews of the storage or copied
+    # straight into the reader's buffer
+    def __init__(self, capacity=1 << 16):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        n = len(data)
+        if self.size + n > len(self.buffer):
+            self._grow(self.size + n)
+        capacity = len(self.buffer)
+        end = (self.start + self.size) % capacity
+        first = min(n, capacity - end)
+        self.view[end:end + first] = data[:first]
+        self.view[:n - first] = data[first:]
+        self.size += n
+
+    def _grow(self, needed):
+        capacity = len(self.buffer)
+        while capacity < needed:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        self._copy(memoryview(buffer), self.size)
+        # views handed out earlier keep the old storage alive
+        self.buffer, self.view, self.start = buffer, memoryview(buffer), 0
+
+    def _copy(self, out, n):
+        capacity = len(self.buffer)
+        first = min(n, capacity - self.start)
+        out[:first] = self.view[self.start:self.start + first]
+        out[first:n] = self.view[:n - first]
+
+    def peek(self, n):
+        # the next n bytes without copying, or None when they wrap around the
+        # end of the storage
+        if n > self.size or self.start + n > len(self.buffer):
+            return None
+        return self.view[self.start:self.start + n]
+
+    def consume(self, n):
+        n = min(n, self.size)
+        self.start = (self.start + n) % len(self.buffer)
+        self.size -= n
+        if not self.size:
+            self.start = 0
+        return n
+
+    def readinto(self, b):
+        out = memoryview(b).cast("B")
+        n = min(len(out), self.size)
+        self._copy(out, n)
+        return self.consume(n)
+
+    def read(self, n):
+        out = bytearray(min(n, self.size))
+        self.readinto(out)
+        return bytes(out)
+
+
+class StreamDecoder:
+    # replacement for resemble.stream_decoder.StreamDecoder: pcm is kept in a
+    # ring buffer whose capacity is a multiple of buffer_size, so
+    # flush_buffer() hands out fixed size memoryviews without copying. A view
+    # is only valid until the next decode_chunk() call. header_parser(data)
+    # returns how many leading bytes to skip, or None while it needs more
+    def __init__(self, buffer_size, ignore_wav_header=True, header_parser=wav_header_size, capacity=16):
+        if buffer_size < 2:
+            raise ValueError("Buffer size cannot be less than 2")
+        if buffer_size % 2 != 0:
+            raise ValueError("Buffer size must be evenly divisible by 2.")
+        self.buffer_size = buffer_size
+        self.header_parser = header_parser if ignore_wav_header else None
+        self.header_buffer = bytearray()
+        self.ring = RingBuffer(buffer_size * capacity)
+
+    def decode_chunk(self, chunk):
+        if self.header_parser is None:
+            self.ring.write(chunk)
+            return
+        self.header_buffer += chunk
+        skip = self.header_parser(self.header_buffer)
+        if skip is not None:
+            self.ring.write(memoryview(self.header_buffer)[skip:])
+            self.header_buffer = bytearray()
+            self.header_parser = None
+
+    def flush_buffer(self, force=False):
+        # buffer_size bytes, or with force whatever is left; None when there
+        # is not enough
+        n = len(self.ring) if force else self.buffer_size
+        if not n or len(self.ring) < n:
+            return None
+        view = self.ring.peek(n)
+        if view is None:
+            return self.ring.read(n)
+        self.ring.consume(n)
+        return view
+
+    def readinto(self, b):
+        return self.ring.readinto(b)
+
+    def __len__(self):
+        return len(self.ring)
+
+
+def stream_clip(project_uuid, voice_uuid, body, buffer_size, sample_rate=None,
+                header_parser=wav_header_size, session=None, timeout=(10, 60)):
+    # Resemble.v2.clips.stream without its per-chunk copies: the response is
+    # read up to buffer_size at a time as it arrives (the SDK reads it two
+    # bytes at a time) and yields buffer_size memoryviews of pcm, then the
+    # remainder. timeout is (connect, read) in seconds; the read timeout
+    # applies to each wait for data, not to the whole stream
+    options = {"project_uuid": project_uuid, "voice_uuid": voice_uuid, "data": body}
+    if sample_rate:
+        options["sample_rate"] = sample_rate
+    r = (session or requests).post(Resemble.syn_server_endpoint("stream"), headers=Resemble._syn_server_headers,
+                                   json=options, stream=True, timeout=timeout)
+    with r:
+        r.raise_for_status()
+        decoder = StreamDecoder(buffer_size, header_parser=header_parser)
+        for chunk in r.iter_content(chunk_size=buffer_size):
+            decoder.decode_chunk(chunk)
+            buffer = decoder.flush_buffer()
+            while buffer is not None:
+                yield buffer
+                buffer = decoder.flush_buffer()
+        buffer = decoder.flush_buffer(force=True)
+        if buffer is not None:
+            yield buffer
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+
+
+class RecordingUploader:
+    # the recording calls made while training a voice, on the shared async
+    # Resemble client with at most `parallelism` of them in flight
+    def __init__(self, client, parallelism=4):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(parallelism)
+
+    async def list_recordings(self, voice_uuid, page_size=1000):
+        recordings = []
+        page = 1
+        while True:
+            async with self.semaphore:
+                response = await self.client.v2.recordings.all(voice_uuid, page, page_size)
+            recordings.extend(response.items)
+            if page >= response.num_pages:
+                return recordings
+            page += 1
+
+    async def delete_recording(self, voice_uuid, recording_uuid):
+        async with self.semaphore:
+            return await self.client.v2.recordings.delete(voice_uuid, recording_uuid)
+
+    async def create_recording(self, voice_uuid, path, name, text, is_active=True, emotion="neutral"):
+        audio = await asyncio.to_thread(_read_file, path)
+        async with self.semaphore:
+            response = await self.client.v2.recordings.create(
+                voice_uuid, audio, name, text, is_active, emotion, filename=os.path.basename(path))
+        return response.item
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class UploadManifest:
+    # remembers the voice being trained from a recordings directory and which
+    # chunk contents (by hash) were already uploaded, so an interrupted !train
+    # resumes instead of starting over
+    def __init__(self, rec_dir, name="uploads.json"):
+        self.path = os.path.join(rec_dir, name)
+        self.voice_uuid = None
+        self.uploaded = {}  # audio hash -> recording uuid
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.voice_uuid = data["voice_uuid"]
+            self.uploaded = data["uploaded"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"voice_uuid": self.voice_uuid, "uploaded": self.uploaded}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.voice_uuid = None
+        self.uploaded = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,94 @@
+import numpy as np
+
+# loudness of full scale 16 bit audio, the 0 dBFS reference
+FULL_SCALE_POWER = 32768.0 ** 2
+
+
+def frame_levels(samples, channels, frame_samples):
+    # loudness in dBFS of each whole frame of interleaved 16 bit samples
+    frame_size = channels * frame_samples
+    n = len(samples) // frame_size
+    frames = np.asarray(samples[:n * frame_size], dtype=np.float32).reshape(n, frame_size)
+    power = np.einsum("ij,ij->i", frames, frames) / frame_size
+    return 10 * np.log10(np.maximum(power, 1e-10) / FULL_SCALE_POWER)
+
+
+def dilate(mask, frames):
+    # marks every frame within `frames` of a marked frame, in O(n)
+    if not frames or not len(mask):
+        return mask
+    counts = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+    index = np.arange(len(mask))
+    hi = np.minimum(index + frames + 1, len(mask))
+    lo = np.maximum(index - frames, 0)
+    return counts[hi] - counts[lo] > 0
+
+
+def regions(mask):
+    # [start, end) frame ranges where mask is set
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
+class SpeechDetector:
+    # energy based voice activity detection over 20 ms frames. Speech regions
+    # (padded by hangover_ms) closer than max_gap_ms are joined into chunks of
+    # at most max_chunk_ms, so chunks are cut at pauses and long silences are
+    # left out; chunks shorter than min_chunk_ms are dropped
+    def __init__(self, threshold_db=-45.0, frame_ms=20, hangover_ms=200, max_gap_ms=1000,
+                 min_chunk_ms=1000, max_chunk_ms=10000, block_frames=500):
+        self.threshold_db = threshold_db
+        self.frame_ms = frame_ms
+        self.hangover = hangover_ms // frame_ms
+        self.max_gap = max_gap_ms // frame_ms
+        self.min_chunk = min_chunk_ms // frame_ms
+        self.max_chunk = max_chunk_ms // frame_ms
+        self.block_frames = block_frames
+
+    def levels(self, path, offset, length, sample_rate, channels, sample_width):
+        # reads the pcm through a memory map a block at a time so long
+        # sessions never have to fit in memory as floats
+        if sample_width != 2:
+            raise ValueError("speech detection needs 16 bit audio")
+        frame_samples = sample_rate * self.frame_ms // 1000
+        count = length // 2
+        if count < frame_samples * channels:
+            return np.empty(0, dtype=np.float32)
+        samples = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(count,))
+        step = self.block_frames * frame_samples * channels
+        return np.concatenate([
+            frame_levels(samples[i:i + step], channels, frame_samples) for i in range(0, count, step)
+        ])
+
+    def plan(self, levels):
+        # [start, end) frame ranges of the chunks to keep
+        speech = dilate(levels > self.threshold_db, self.hangover)
+        chunks = []
+        start = end = None
+        for lo, hi in regions(speech):
+            if start is not None and lo - end <= self.max_gap and hi - start <= self.max_chunk:
+                end = hi
+                continue
+            if start is not None:
+                chunks.append((start, end))
+            start, end = lo, hi
+            # a region longer than a chunk is cut at its quietest frame
+            # within the last quarter of each chunk
+            while end - start > self.max_chunk:
+                window_start = start + self.max_chunk * 3 // 4
+                cut = window_start + int(np.argmin(levels[window_start:start + self.max_chunk]))
+                chunks.append((start, cut))
+                start = cut
+        if start is not None:
+            chunks.append((start, end))
+        return [(lo, hi) for lo, hi in chunks if hi - lo >= self.min_chunk]
+
+    def chunks(self, path, offset, length, sample_rate, channels, sample_width):
+        # byte ranges of the file holding the speech chunks of one session
+        levels = self.levels(path, offset, length, sample_rate, channels, sample_width)
+        frame_size = sample_rate * self.frame_ms // 1000 * channels * sample_width
+        return [(offset + lo * frame_size, offset + hi * frame_size) for lo, hi in self.plan(levels)]
+
+    def speech_seconds(self, path, offset, length, sample_rate, channels, sample_width):
+        levels = self.levels(path, offset, length, sample_rate, channels, sample_width)
+        return sum(hi - lo for lo, hi in self.plan(levels)) * self.frame_ms / 1000
@@ -0,0 +1,271 @@
+import audioop
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+from discord.opus import Encoder
+
+from ogg_opus import iter_opus_packets
+from tts_stream import RingBuffer
+from voice_recording import OPUS_SILENCE
+
+# one 20 ms frame of 48 kHz 16 bit stereo, what AudioPlayer sends per loop
+FRAME_SIZE = Encoder.FRAME_SIZE
+SILENCE_FRAME = bytes(FRAME_SIZE)
+
+
+class PcmConverter:
+    # converts pcm of any rate, channel count and sample width to the player's
+    # 48 kHz 16 bit stereo one buffer at a time; the resampler state and any
+    # partial sample frame are carried over to the next buffer
+    def __init__(self, sample_rate, channels=1, sample_width=2):
+        if channels not in (1, 2):
+            raise ValueError("only mono and stereo audio can be played")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.block_align = channels * sample_width
+        self.state = None
+        self.remainder = b""
+
+    def convert(self, data):
+        # data can be any bytes-like object; it is only copied when a sample
+        # frame is split between buffers
+        if self.remainder:
+            data = self.remainder + data
+        usable = len(data) - len(data) % self.block_align
+        if usable < len(data):
+            self.remainder = bytes(data[usable:])
+            data = memoryview(data)[:usable]
+        else:
+            self.remainder = b""
+        if not usable:
+            return b""
+
+        if self.sample_width != 2:
+            data = audioop.lin2lin(data, self.sample_width, 2)
+        if self.sample_rate != Encoder.SAMPLING_RATE:
+            # resample before upmixing so mono audio is resampled only once
+            data, self.state = audioop.ratecv(
+                data, 2, self.channels, self.sample_rate, Encoder.SAMPLING_RATE, self.state)
+        if self.channels == 1:
+            data = audioop.tostereo(data, 2, 1, 1)
+        return data
+
+
+class StreamingAudioSource(discord.AudioSource):
+    # plays pcm buffers from a blocking iterator (like Resemble's streaming
+    # synthesis) while it is still producing them: a thread pulls and converts
+    # the buffers into a ring buffer that read() takes 20 ms frames from, and
+    # read() plays silence instead of stopping when the stream falls behind.
+    # wait_ready() blocks until prebuffer_ms of audio is queued so playback
+    # can start right away. With keep, the converted audio is also kept in
+    # recording, which is complete once the stream ends with complete set
+    def __init__(self, buffers, sample_rate, channels=1, sample_width=2, prebuffer_ms=60, keep=False):
+        self.buffers = buffers
+        self.converter = PcmConverter(sample_rate, channels, sample_width)
+        self.prebuffer = max(prebuffer_ms // Encoder.FRAME_LENGTH, 1)  # frames
+        self.ring = RingBuffer(FRAME_SIZE * 64)
+        self.condition = threading.Condition()
+        self.recording = self._new_recording() if keep else None
+        self.done = False
+        self.complete = False
+        self.closed = False
+        self.error = None
+        self.started = time.perf_counter()
+        self.first_audio = None  # seconds until the first frame was ready
+        self.underruns = 0
+        self.thread = threading.Thread(target=self._fill, daemon=True, name="StreamingAudioSource")
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            for buffer in self.buffers:
+                if self.closed:
+                    break
+                self._push(self.converter.convert(buffer))
+            else:
+                self.complete = True
+            self._finish()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def _new_recording(self):
+        return bytearray()
+
+    def _finish(self):
+        # the last partial frame is padded when it is read
+        pass
+
+    def _ready(self):
+        return len(self.ring) >= self.prebuffer * FRAME_SIZE
+
+    def _has_audio(self):
+        return len(self.ring) > 0
+
+    def _push(self, data):
+        if not data:
+            return
+        with self.condition:
+            if self.first_audio is None:
+                self.first_audio = time.perf_counter() - self.started
+            self.ring.write(data)
+            self.condition.notify_all()
+        if self.recording is not None:
+            self.recording += data
+
+    def wait_ready(self, timeout=None):
+        # True once there is audio to play, False if the stream ended (or
+        # failed) without any or the timeout passed
+        with self.condition:
+            self.condition.wait_for(lambda: self.done or self._ready(), timeout)
+            return self._has_audio()
+
+    def read(self):
+        with self.condition:
+            if len(self.ring) >= FRAME_SIZE:
+                return self.ring.read(FRAME_SIZE)
+            if self.done:
+                # the last partial frame is padded with silence
+                return self.ring.read(FRAME_SIZE).ljust(FRAME_SIZE, b"\0") if len(self.ring) else b""
+        self.underruns += 1
+        return SILENCE_FRAME
+
+    def readinto(self, b):
+        # copies as much queued 48 kHz stereo pcm as fits into b
+        with self.condition:
+            return self.ring.readinto(b)
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        # the fill thread stops after its current buffer (and the recording
+        # stays incomplete)
+        self.closed = True
+        with self.condition:
+            self.ring.consume(len(self.ring))
+
+
+def encode_frames(encoder, pcm):
+    # one opus packet per whole 20 ms frame of 48 kHz stereo pcm
+    return [
+        encoder.encode(bytes(pcm[i:i + FRAME_SIZE]), Encoder.SAMPLES_PER_FRAME)
+        for i in range(0, len(pcm) - FRAME_SIZE + 1, FRAME_SIZE)
+    ]
+
+
+def _encode_into(callback, encoder, pcm):
+    callback(encode_frames(encoder, pcm))
+
+
+class OpusEncoderPool:
+    # a few threads shared by every voice connection that encode pcm to opus
+    # (libopus runs without holding the GIL). An encoder keeps state between
+    # frames, so each stream passes its own and submits its next pcm only
+    # once the previous encode is done
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="OpusEncoder")
+
+    def submit(self, encoder, pcm, callback):
+        # callback(packets) runs on the pool thread before the future is done
+        return self.executor.submit(_encode_into, callback, encoder, pcm)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class OpusStreamingSource(StreamingAudioSource):
+    # StreamingAudioSource that encodes the audio on an OpusEncoderPool as it
+    # arrives, so the player thread only paces and sends packets. A buffer is
+    # encoded while the fill thread reads and converts the next one. With
+    # keep, recording is the list of packets
+    def __init__(self, buffers, sample_rate, encoder_pool, **kwargs):
+        self.encoder_pool = encoder_pool
+        self.encoder = Encoder()
+        self.encoding = None  # future of the encode in flight
+        self.pcm = bytearray()
+        self.packets = deque()
+        super().__init__(buffers, sample_rate, **kwargs)
+
+    def _new_recording(self):
+        return []
+
+    def _ready(self):
+        return len(self.packets) >= self.prebuffer
+
+    def _has_audio(self):
+        return bool(self.packets)
+
+    def _push(self, data):
+        self.pcm += data
+        usable = len(self.pcm) - len(self.pcm) % FRAME_SIZE
+        if usable:
+            pcm = bytes(self.pcm[:usable])
+            del self.pcm[:usable]
+            self._encode(pcm)
+
+    def _encode(self, pcm):
+        # waits for the previous encode (raising its error), since both use
+        # the stream's encoder
+        if self.encoding is not None:
+            self.encoding.result()
+        self.encoding = self.encoder_pool.submit(self.encoder, pcm, self._queue)
+
+    def _finish(self):
+        if self.pcm and not self.closed:
+            self._encode(bytes(self.pcm.ljust(FRAME_SIZE, b"\0")))
+            self.pcm.clear()
+        if self.encoding is not None:
+            self.encoding.result()
+
+    def _queue(self, packets):
+        with self.condition:
+            if self.first_audio is None:
+                self.first_audio = time.perf_counter() - self.started
+            self.packets.extend(packets)
+            self.condition.notify_all()
+        if self.recording is not None:
+            self.recording.extend(packets)
+
+    def read(self):
+        with self.condition:
+            if self.packets:
+                return self.packets.popleft()
+            if self.done:
+                return b""
+        self.underruns += 1
+        return OPUS_SILENCE
+
+    def readinto(self, b):
+        raise TypeError("an opus source has no pcm to read")
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.closed = True
+        with self.condition:
+            self.packets.clear()
+
+
+class OggOpusSource(discord.AudioSource):
+    # plays the 20 ms packets of an Ogg/Opus file object as they are stored
+    def __init__(self, f):
+        self.f = f
+        self.packets = iter_opus_packets(f)
+
+    def read(self):
+        return next(self.packets, b"")
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.f.close()
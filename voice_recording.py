@@ -0,0 +1,500 @@
+import asyncio
+import os
+import select
+import struct
+import threading
+import time
+from collections import deque
+
+import discord
+import nacl.secret
+from discord.opus import Decoder, OpusError, _OpusStruct
+from discord.sinks import Filters, RawData, RecordingException, Sink
+
+from fast_silence import StreamingSilenceDetector
+
+# sequence, timestamp and ssrc fields of an RTP header
+RTP_HEADER = struct.Struct(">xxHII")
+# opus frame discord sends while a user is silent
+OPUS_SILENCE = b"\xf8\xff\xfe"
+
+
+class SpoolSegment:
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.file = open(path, "w+b")
+        self.offset = offset  # position of its first byte in the user's audio
+        self.size = 0
+        self.started = time.time()
+        self.ended = None
+
+
+class SpoolSink(Sink):
+    # writes decoded pcm to per-user spool files while recording instead of
+    # keeping it in memory: at most max_memory bytes are buffered across all
+    # users, and a user's spool file is rotated once it reaches rotate_bytes or
+    # rotate_seconds. Pauses of max_silence_seconds or more, found in the live
+    # pcm by a StreamingSilenceDetector or as gaps between packets, end the
+    # segment and are left out but for keep_silence_ms on either side.
+    # Finished segments are handed to on_segment(user, segment) in order on
+    # the sink's own store thread, so a slow consumer never holds up the
+    # decode workers
+
+    # pcm format produced by the opus decoder
+    sample_rate = Decoder.SAMPLING_RATE
+    channels = Decoder.CHANNELS
+    sample_width = Decoder.SAMPLE_SIZE // Decoder.CHANNELS
+
+    def __init__(self, spool_dir, on_segment, *, filters=None, max_memory=4 << 20, flush_size=256 << 10,
+                 rotate_bytes=64 << 20, rotate_seconds=300, max_silence_seconds=2.0, silence_thresh=-45.0,
+                 keep_silence_ms=250):
+        super().__init__(filters=filters)
+        self.encoding = "pcm"
+        self.spool_dir = spool_dir
+        self.on_segment = on_segment
+        self.max_memory = max_memory
+        self.flush_size = flush_size
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.max_silence_ms = int(max_silence_seconds * 1000)
+        self.silence_thresh = silence_thresh
+        self.keep_silence_ms = keep_silence_ms
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.buffers = {}  # user -> bytearray not yet written
+        self.positions = {}  # user -> bytes of their audio written to spool files
+        self.detectors = {}  # user -> StreamingSilenceDetector fed everything written
+        self.segments = {}  # user -> open SpoolSegment
+        self.counts = {}
+        self.finished_segments = deque()
+        self.buffered = 0
+        os.makedirs(spool_dir, exist_ok=True)
+        self.store_thread = threading.Thread(target=self._store_segments, daemon=True, name="SpoolSinkStore")
+        self.store_thread.start()
+
+    @Filters.container
+    def write(self, data, user):
+        with self.lock:
+            buffer = self._buffer(user)
+            buffer += data
+            self.buffered += len(data)
+            self._cut_pauses(user, self._detector(user).feed(data))
+
+            if len(buffer) >= self.flush_size:
+                self._flush(user)
+            if self.buffered > self.max_memory:
+                for other in list(self.buffers):
+                    self._flush(other)
+
+    @Filters.container
+    def write_silence(self, samples, user):
+        # a short gap is skipped over in the spool file instead of writing
+        # zeros (the hole reads back as silence once the next audio is written
+        # after it) and the detector sees it as the zeros it stands for; a
+        # long one is a pause, so the audio before it is finished
+        with self.lock:
+            self._buffer(user)
+            if samples * 1000 // self.sample_rate < self.max_silence_ms:
+                self._flush(user)
+                segment = self._segment(user)
+                size = samples * self.channels * self.sample_width
+                segment.file.seek(size, os.SEEK_CUR)
+                segment.size += size
+                self.positions[user] += size
+                self._cut_pauses(user, self._detector(user).feed(bytes(size)))
+            else:
+                # the next packet has already arrived, the audio ended a gap ago
+                self._end_audio(user, ended=time.time() - samples / self.sample_rate)
+
+    def _buffer(self, user):
+        buffer = self.buffers.get(user)
+        if buffer is None:
+            buffer = self.buffers[user] = bytearray()
+            self.positions[user] = 0
+        return buffer
+
+    def _detector(self, user):
+        detector = self.detectors.get(user)
+        if detector is None:
+            detector = self.detectors[user] = StreamingSilenceDetector(
+                self.sample_rate, self.channels, self.sample_width, min_silence_len=self.max_silence_ms,
+                silence_thresh=self.silence_thresh, seek_step=10)
+        return detector
+
+    def _segment(self, user):
+        segment = self.segments.get(user)
+        if segment is None:
+            n = self.counts.get(user, 0)
+            self.counts[user] = n + 1
+            path = os.path.join(self.spool_dir, f"{user}_{int(time.time())}_{n}.pcm")
+            segment = self.segments[user] = SpoolSegment(path, self.positions[user])
+        return segment
+
+    def _flush(self, user):
+        buffer = self.buffers[user]
+        if not buffer:
+            return
+        segment = self._segment(user)
+        segment.file.write(buffer)
+        segment.size += len(buffer)
+        self.positions[user] += len(buffer)
+        self.buffered -= len(buffer)
+        buffer.clear()
+
+        detector = self.detectors.get(user)
+        if detector is not None and detector.in_silence:
+            # rotated once the pause is cut out, so it is not split between files
+            return
+        if segment.size >= self.rotate_bytes or time.time() - segment.started >= self.rotate_seconds:
+            self._close(user)
+
+    def _cut_pauses(self, user, pauses):
+        # pauses are [start, end] ms of the user's audio
+        ms_size = self.sample_rate // 1000 * self.channels * self.sample_width
+        keep = self.keep_silence_ms * ms_size
+        for start, end in pauses:
+            end = end * ms_size
+            if end >= self.positions[user] + len(self.buffers[user]):
+                # the audio ends in this pause, nothing follows it to keep
+                self._cut(user, start * ms_size + keep, end)
+            else:
+                self._cut(user, start * ms_size + keep, end - keep)
+
+    def _cut(self, user, start, end):
+        # leaves bytes [start, end) of the user's audio out: what comes before
+        # them finishes the open segment and what comes after starts a new one
+        segment = self.segments.get(user)
+        if start >= end or end <= (segment.offset if segment else self.positions[user]):
+            # the pause is in a segment that was already rotated out
+            return
+        buffer = self.buffers[user]
+        segment = self._segment(user)
+        segment.file.write(buffer)
+        segment.size += len(buffer)
+        self.positions[user] += len(buffer)
+        self.buffered -= len(buffer)
+        buffer.clear()
+
+        written = self.positions[user]
+        now = time.time()
+        rate = self.sample_rate * self.channels * self.sample_width
+        segment.file.seek(end - segment.offset)
+        # a hole at the end of the file was never written, so it reads short
+        tail = segment.file.read().ljust(written - end, b"\0")
+        head = max(start - segment.offset, 0)
+        if head:
+            segment.file.truncate(head)
+            segment.size = head
+            self._close(user, ended=now - (written - start) / rate)
+        else:
+            self.segments.pop(user)
+            segment.file.close()
+            os.remove(segment.path)
+
+        self.positions[user] = end
+        if tail:
+            buffer += tail
+            self.buffered += len(tail)
+            self._segment(user).started = now - (written - end) / rate
+
+    def _end_audio(self, user, ended=None):
+        # finishes the user's audio so far; whatever is written next starts a
+        # new segment and a new run of pause detection
+        detector = self.detectors.pop(user, None)
+        if detector is not None:
+            self._cut_pauses(user, detector.finish())
+        self._flush(user)
+        self._close(user, ended)
+        self.positions[user] = 0
+
+    def _close(self, user, ended=None):
+        segment = self.segments.pop(user, None)
+        if segment is None:
+            return
+        segment.file.close()
+        segment.ended = max(ended, segment.started) if ended is not None else time.time()
+        self.finished_segments.append((user, segment))
+        self.condition.notify()
+
+    def _store_segments(self):
+        # runs until cleanup() and every segment finished before it is handed off
+        while True:
+            with self.condition:
+                while not self.finished_segments and not self.finished:
+                    self.condition.wait()
+                if not self.finished_segments:
+                    return
+                user, segment = self.finished_segments.popleft()
+            try:
+                self.on_segment(user, segment)
+            except Exception as e:
+                print(f"Failed to store spool segment {segment.path}: {e!r}")
+
+    def cleanup(self):
+        # waits for the store thread, so every segment is stored on return
+        with self.lock:
+            self.finished = True
+            for user in list(self.buffers):
+                self._end_audio(user)
+            self.buffers = {}
+            self.condition.notify()
+        self.store_thread.join()
+
+    def get_all_audio(self):
+        return []
+
+
+class _DecodeWorker(threading.Thread):
+    # decodes the packets of the ssrcs assigned to it; sleeps on a condition
+    # while idle and drops the oldest packet when max_queue is reached
+    def __init__(self, client, index, max_queue):
+        super().__init__(daemon=True, name=f"DecodeWorker-{index}")
+        self.client = client
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.decoders = {}
+        self.dropped = 0
+        self.stopping = False
+
+    def put(self, data):
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(data)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                data = self.queue.popleft()
+
+            if data.decrypted_data is None:
+                continue
+            decoder = self.decoders.get(data.ssrc)
+            if decoder is None:
+                decoder = self.decoders[data.ssrc] = Decoder()
+            try:
+                data.decoded_data = decoder.decode(data.decrypted_data)
+            except OpusError:
+                print("Error occurred while decoding opus frame.")
+                continue
+            self.client.recv_decoded_audio(data)
+
+    def stop(self):
+        # lets the worker finish what is queued, then exit
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+
+class QueuedDecodeManager(_OpusStruct):
+    # stands in for discord.opus.DecodeManager: packets are sharded by ssrc
+    # over `workers` threads so every stream is decoded by one thread in order
+    def __init__(self, client, workers=1, max_queue=500):
+        self.client = client
+        self.workers = [_DecodeWorker(client, i, max_queue) for i in range(workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def decode(self, opus_frame):
+        if not isinstance(opus_frame, (RawData, RtpPacket)):
+            raise TypeError("opus_frame should be a RawData or RtpPacket object.")
+        self.workers[opus_frame.ssrc % len(self.workers)].put(opus_frame)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+        dropped = sum(worker.dropped for worker in self.workers)
+        if dropped:
+            print(f"Decoder dropped {dropped} packets")
+
+    @property
+    def decoding(self):
+        return any(worker.queue for worker in self.workers)
+
+
+class RtpPacket:
+    # the parts of a voice packet the decoder and sink use, see RawData
+    __slots__ = ("sequence", "timestamp", "ssrc", "decrypted_data", "decoded_data", "user_id")
+
+    def __init__(self, sequence, timestamp, ssrc, decrypted_data):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.ssrc = ssrc
+        self.decrypted_data = decrypted_data
+        self.decoded_data = None
+        self.user_id = None
+
+
+class RecordingVoiceClient(discord.VoiceClient):
+    # receives voice with reused buffers, drops packets from users the sink
+    # does not record before they are decrypted and decoded, and decodes them
+    # with a QueuedDecodeManager
+    decode_workers = 1
+    decode_queue_size = 500
+    # decoded frames kept per ssrc while waiting for the gateway to map it
+    max_pending_frames = 500
+    # packets read per wakeup and the size of each receive buffer
+    recv_batch_size = 32
+    recv_buffer_size = 4096
+
+    _box = None
+    _box_key = None
+
+    def start_recording(self, sink, callback, *args):
+        # same as VoiceClient.start_recording, with the queued decode manager
+        if not self.is_connected():
+            raise RecordingException("Not connected to voice channel.")
+        if self.recording:
+            raise RecordingException("Already recording.")
+        if not isinstance(sink, Sink):
+            raise RecordingException("Must provide a Sink object.")
+
+        self.empty_socket()
+
+        self.decoder = QueuedDecodeManager(self, self.decode_workers, self.decode_queue_size)
+        self.decoder.start()
+        self.recording = True
+        self.sink = sink
+        sink.init(self)
+
+        t = threading.Thread(target=self.recv_audio, args=(sink, callback, *args))
+        t.start()
+
+    def wants_ssrc(self, ssrc):
+        users = self.sink.filtered_users if self.sink else None
+        if not users:
+            return True
+        info = self.ws.ssrc_map.get(ssrc)
+        # an ssrc the gateway has not mapped yet could still be a target
+        return info is None or info["user_id"] in users
+
+    def recv_audio(self, sink, callback, *args):
+        # reads every packet that is ready into a pool of preallocated buffers
+        # before handling them, instead of one recv and one select per packet
+        self.user_timestamps = {}
+        self.pending_frames = {}
+        self.starting_time = time.perf_counter()
+        buffers = [bytearray(self.recv_buffer_size) for _ in range(self.recv_batch_size)]
+        views = [memoryview(buffer) for buffer in buffers]
+        sizes = [0] * self.recv_batch_size
+        decrypt = getattr(self, f"_decrypt_{self.mode}")
+
+        while self.recording:
+            ready, _, err = select.select([self.socket], [], [self.socket], 0.05)
+            if not ready:
+                if err:
+                    print(f"Socket error: {err}")
+                continue
+
+            count = 0
+            try:
+                while count < self.recv_batch_size:
+                    sizes[count] = self.socket.recv_into(buffers[count])
+                    count += 1
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.stop_recording()
+                continue
+
+            for i in range(count):
+                self._handle_packet(views[i][:sizes[i]], decrypt)
+
+        self.stopping_time = time.perf_counter()
+        self.sink.cleanup()
+        callback = asyncio.run_coroutine_threadsafe(callback(self.sink, *args), self.loop)
+        result = callback.result()
+
+        if result is not None:
+            print(result)
+
+    def recv_decoded_audio(self, data):
+        # runs on a decode worker; gaps between a user's packets are passed to
+        # the sink as a number of silent samples and frames from ssrcs the
+        # gateway has not mapped yet are parked instead of blocking the worker
+        previous = self.user_timestamps.get(data.ssrc)
+        silence = 0
+        if previous is None:
+            self.user_timestamps[data.ssrc] = data.timestamp
+        else:
+            # rtp timestamps wrap at 2**32, a "negative" gap is a late packet,
+            # which must not move the stream's position back
+            gap = (data.timestamp - previous) & 0xFFFFFFFF
+            if gap < 0x80000000:
+                self.user_timestamps[data.ssrc] = data.timestamp
+                silence = max(gap - Decoder.SAMPLES_PER_FRAME, 0)
+
+        info = self.ws.ssrc_map.get(data.ssrc)
+        if info is None:
+            pending = self.pending_frames.setdefault(data.ssrc, deque(maxlen=self.max_pending_frames))
+            pending.append((silence, data.decoded_data))
+            return
+
+        user = info["user_id"]
+        pending = self.pending_frames.pop(data.ssrc, None)
+        if pending:
+            for pending_silence, pcm in pending:
+                self._write_audio(user, pending_silence, pcm)
+        self._write_audio(user, silence, data.decoded_data)
+
+    def _write_audio(self, user, silence, pcm):
+        if silence:
+            write_silence = getattr(self.sink, "write_silence", None)
+            if write_silence is not None:
+                write_silence(silence, user)
+            else:
+                self.sink.write(bytes(silence * Decoder.SAMPLE_SIZE), user)
+        self.sink.write(pcm, user)
+
+    def unpack_audio(self, data):
+        self._handle_packet(memoryview(data), getattr(self, f"_decrypt_{self.mode}"))
+
+    def _handle_packet(self, data, decrypt):
+        if len(data) < 12 or 200 <= data[1] <= 204:
+            # too short or RTCP, not audio
+            return
+        if self.paused:
+            return
+        sequence, timestamp, ssrc = RTP_HEADER.unpack_from(data)
+        if not self.wants_ssrc(ssrc):
+            return
+
+        decrypted = decrypt(data[:12], data[12:])
+        if decrypted == OPUS_SILENCE:
+            return
+
+        self.decoder.decode(RtpPacket(sequence, timestamp, ssrc, decrypted))
+
+    def _secret_box(self):
+        # VoiceClient builds a new SecretBox for every packet
+        if self._box_key is not self.secret_key:
+            self._box = nacl.secret.SecretBox(bytes(self.secret_key))
+            self._box_key = self.secret_key
+        return self._box
+
+    def _decrypt_xsalsa20_poly1305(self, header, data):
+        nonce = bytearray(24)
+        nonce[:12] = header
+        return self.strip_header_ext(self._secret_box().decrypt(bytes(data), bytes(nonce)))
+
+    def _decrypt_xsalsa20_poly1305_suffix(self, header, data):
+        nonce_size = nacl.secret.SecretBox.NONCE_SIZE
+        return self.strip_header_ext(
+            self._secret_box().decrypt(bytes(data[:-nonce_size]), bytes(data[-nonce_size:]))
+        )
+
+    def _decrypt_xsalsa20_poly1305_lite(self, header, data):
+        nonce = bytearray(24)
+        nonce[:4] = data[-4:]
+        return self.strip_header_ext(self._secret_box().decrypt(bytes(data[:-4]), bytes(nonce)))
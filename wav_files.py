@@ -0,0 +1,132 @@
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# RIFF header, fmt chunk and data chunk header of a plain PCM wav file
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+CHUNK_HEADER = struct.Struct("<4sI")
+# sizes written by encoders that do not know the length up front
+UNKNOWN_SIZES = (0, 0xFFFFFFFF)
+
+
+class WavInfo(namedtuple("WavInfo", ["sample_rate", "channels", "sample_width", "segments"])):
+    # segments are (offset, size) byte ranges of pcm data in the file
+
+    @property
+    def block_align(self):
+        return self.channels * self.sample_width
+
+    @property
+    def data_size(self):
+        return sum(size for _, size in self.segments)
+
+    @property
+    def frames(self):
+        return self.data_size // self.block_align
+
+    @property
+    def duration(self):
+        return self.frames / self.sample_rate
+
+
+def _read_header(f, path):
+    # reads one RIFF/WAVE header up to the start of its data, returns the
+    # format and the declared data size
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+        raise ValueError(f"{path} is not a wav file")
+
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError(f"{path} has no data chunk")
+        chunk_id, size = CHUNK_HEADER.unpack(header)
+        if chunk_id == b"fmt ":
+            fmt = f.read(size)
+            f.seek(size & 1, os.SEEK_CUR)
+        elif chunk_id == b"data":
+            break
+        else:
+            f.seek(size + (size & 1), os.SEEK_CUR)
+    if fmt is None or len(fmt) < 16:
+        raise ValueError(f"{path} has no fmt chunk")
+
+    _, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from("<HHIIHH", fmt)
+    return (sample_rate, channels, bits_per_sample // 8), size
+
+
+def read_wav_info(path):
+    # only headers are read: recordings made by appending whole wav files are
+    # followed from one embedded header to the next, and a data size that is
+    # unknown or runs past the end of the file means "until the end"
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        audio_format, size = _read_header(f, path)
+        segments = []
+        while True:
+            offset = f.tell()
+            if size in UNKNOWN_SIZES or offset + size > file_size:
+                segments.append((offset, file_size - offset))
+                break
+            segments.append((offset, size))
+
+            next_offset = offset + size + (size & 1)
+            f.seek(next_offset)
+            if f.read(4) != b"RIFF":
+                break
+            f.seek(next_offset)
+            next_format, size = _read_header(f, path)
+            if next_format != audio_format:
+                raise ValueError(f"{path} mixes audio formats")
+    return WavInfo(*audio_format, segments)
+
+
+def wav_header(data_size, sample_rate, channels, sample_width):
+    block_align = channels * sample_width
+    return WAV_HEADER.pack(
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, sample_width * 8,
+        b"data", data_size,
+    )
+
+
+def write_wav_chunks(input_path, output_dir, info, chunks, workers=4):
+    # chunks is a list of [(lo, hi), ...] byte ranges of the input; each one
+    # is copied straight from a memory map into chunk_{i}.wav, and chunk files
+    # left over from an earlier, longer split are removed
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        stem, ext = os.path.splitext(name)
+        if stem.startswith("chunk_") and ext in (".wav", ".txt") and stem[6:].isdigit() and int(stem[6:]) >= len(chunks):
+            os.remove(os.path.join(output_dir, name))
+    if not chunks:
+        return []
+
+    start_time = time.perf_counter()
+    with open(input_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+
+        def write_chunk(i):
+            path = os.path.join(output_dir, f"chunk_{i}.wav")
+            size = sum(hi - lo for lo, hi in chunks[i])
+            with open(path, "wb") as out:
+                out.write(wav_header(size, info.sample_rate, info.channels, info.sample_width))
+                for lo, hi in chunks[i]:
+                    out.write(view[lo:hi])
+            return path
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                paths = list(pool.map(write_chunk, range(len(chunks))))
+        finally:
+            view.release()
+
+    elapsed = time.perf_counter() - start_time
+    size = sum(hi - lo for chunk in chunks for lo, hi in chunk)
+    print(f"Split {input_path} into {len(paths)} chunks in {elapsed:.2f}s "
+          f"({size / (1 << 20) / max(elapsed, 1e-9):.1f} MB/s)")
+    return paths